@@ -0,0 +1,55 @@
+# Keeps big parts of queue items that don't change once they're made, like the proof nodes and the transaction logs,
+# in their own files named after the hash of their contents.
+
+# The item itself just has {"$blob": "<hash>"} in their place, so moving an item between statuses only rewrites
+# the small part that changes. Identical values are only stored once.
+# Blobs are never removed, since we don't keep track of which items still use them.
+
+import os
+import json
+import hashlib
+
+BLOB_REF = '$blob'
+
+class BlobStore:
+
+    def __init__(self, blob_dir):
+        self.blob_dir = blob_dir
+
+    def blobFile(self, blob_hash):
+        return self.blob_dir + '/' + blob_hash[0:2] + '/' + blob_hash + '.json'
+
+    def put(self, value):
+        data = json.dumps(value, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        blob_hash = hashlib.sha256(data).hexdigest()
+        blob_file = self.blobFile(blob_hash)
+        if not os.path.exists(blob_file):
+            os.makedirs(os.path.dirname(blob_file), exist_ok=True)
+            tmp_file = blob_file + '.' + str(os.getpid()) + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_file, blob_file)
+        return blob_hash
+
+    def get(self, blob_hash):
+        with open(self.blobFile(blob_hash)) as f:
+            return json.load(f)
+
+    def isRef(self, value):
+        return isinstance(value, dict) and len(value) == 1 and BLOB_REF in value
+
+    def pack(self, item, fields):
+        # A copy of the item with the fields stored as blobs
+        packed = dict(item)
+        for field in fields:
+            if field not in packed or self.isRef(packed[field]):
+                continue
+            packed[field] = {BLOB_REF: self.put(packed[field])}
+        return packed
+
+    def unpack(self, item):
+        # Replace any blob references in the item with what they refer to
+        for field in item:
+            if self.isRef(item[field]):
+                item[field] = self.get(item[field][BLOB_REF])
+        return item
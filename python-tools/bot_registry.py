@@ -0,0 +1,38 @@
+# Read-only access to parser_config.json for scripts that need to know about the bots.
+
+# load_bots.py replaces the file atomically whenever a bot is added, so we can cheaply check whether
+# it has changed and reload it, rather than every consumer reading it every time or never noticing new bots.
+
+import json
+import os
+
+PARSER_CONFIG = 'parser_config.json'
+
+loaded_stamp = None
+parser_config = {}
+
+def _stamp():
+    try:
+        st = os.stat(PARSER_CONFIG)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def bots():
+    # All the bots, by name, reloaded if the file has been replaced since we last read it
+    global loaded_stamp, parser_config
+    stamp = _stamp()
+    if stamp != loaded_stamp:
+        if stamp is None:
+            parser_config = {}
+        else:
+            with open(PARSER_CONFIG) as f:
+                parser_config = json.load(f)
+        loaded_stamp = stamp
+    return parser_config
+
+def metadata(bot_name):
+    bot_entry = bots().get(bot_name)
+    if bot_entry is None or bot_entry.get('metadata') is None:
+        return {}
+    return bot_entry['metadata']
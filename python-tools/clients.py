@@ -0,0 +1,67 @@
+# The web3 connection, contracts and account, shared between modules and only set up the first time something needs them.
+
+# Importing this is cheap: web3, the .env file and the ABIs are only loaded when you first call one of these,
+# so scripts that only need to prove a CAR or read the queue don't pay for them.
+
+import os
+import json
+
+ENV_FILE = '../contract/.env'
+
+GATEWAY_ABI_FILE = "../contract/out/SkeetGateway.sol/SkeetGateway.json"
+SHADOW_DID_ABI_FILE = "../contract/out/ShadowDIDPLCDirectory.sol/ShadowDIDPLCDirectory.json"
+
+is_env_loaded = False
+abis = {}
+cached_w3 = None
+cached_account = None
+cached_gateway = None
+cached_directory = None
+
+def config(name, default=None):
+    # A setting from ../contract/.env, or the environment
+    global is_env_loaded
+    if not is_env_loaded:
+        from dotenv import load_dotenv
+        load_dotenv(dotenv_path=ENV_FILE)
+        is_env_loaded = True
+    return os.getenv(name, default)
+
+def abi(abi_file):
+    if abi_file not in abis:
+        with open(abi_file) as f:
+            abis[abi_file] = json.load(f)['abi']
+    return abis[abi_file]
+
+def w3():
+    global cached_w3
+    if cached_w3 is None:
+        import web3
+        import rpc_provider
+        cached_w3 = web3.Web3(rpc_provider.TimedHTTPProvider(config('SEPOLIA_RPC_URL')))
+    return cached_w3
+
+def account():
+    global cached_account
+    if cached_account is None:
+        from eth_account import Account
+        cached_account = Account.from_key(config('PRIVATE_KEY'))
+    return cached_account
+
+def gatewayAddress():
+    return config('SKEET_GATEWAY')
+
+def shadowDidAddress():
+    return config('SHADOW_DID')
+
+def gateway():
+    global cached_gateway
+    if cached_gateway is None:
+        cached_gateway = w3().eth.contract(address=gatewayAddress(), abi=abi(GATEWAY_ABI_FILE))
+    return cached_gateway
+
+def directory():
+    global cached_directory
+    if cached_directory is None:
+        cached_directory = w3().eth.contract(address=shadowDidAddress(), abi=abi(SHADOW_DID_ABI_FILE))
+    return cached_directory
@@ -0,0 +1,22 @@
+# Moves finished items in the skeet queue out of their one-file-each directories into the segment archive.
+# They can still be read with skeet_queue.readItem() and still count as seen, so they won't be fetched again.
+
+import os
+
+from dotenv import load_dotenv
+
+import skeet_queue
+
+load_dotenv(dotenv_path='.env')
+
+# Leave things in the directories for a while in case someone wants to look at them
+QUEUE_COMPACT_MIN_AGE = float(os.getenv('QUEUE_COMPACT_MIN_AGE', 24 * 60 * 60))
+
+if __name__ == '__main__':
+
+    skeet_queue.prepare()
+
+    for status in skeet_queue.ARCHIVED_STATUSES:
+        count = skeet_queue.compact(status, QUEUE_COMPACT_MIN_AGE)
+        if count > 0:
+            print("Archived " + str(count) + " " + status + " items")
@@ -2,6 +2,8 @@ import hashlib
 import json
 import os
 
+import timeline
+
 statuses = ['payload', 'payload_retry', 'tx', 'tx_retry', 'report', 'report_retry', 'abandoned', 'completed']
 
 QUEUE_ROOT = "did_queue"
@@ -13,6 +15,10 @@ def prepare():
         if not os.path.exists(QUEUE_ROOT + '/' + s):
             os.mkdir(QUEUE_ROOT + '/' + s)
 
+def itemKey(item):
+    # The arguments that identify the item to the other functions here
+    return (item['did'],)
+
 def hashedName(did):
     return hashlib.sha256(did.encode()).hexdigest()
 
@@ -29,24 +35,60 @@ def queueForPayload(did):
     item = {
         "did": did
     }
+    timeline.enqueued(item, 'payload')
     with open(QUEUE_ROOT + '/payload/' + fn, 'w') as f:
         json.dump(item, f, indent=4)
 
 def updateStatus(did, from_status, to_status, new_content=None):
     fn = hashedName(did)
-    os.rename(QUEUE_ROOT + '/' + from_status + '/' + fn, QUEUE_ROOT + '/' + to_status + '/' + fn)
     if new_content is not None:
-        with open(QUEUE_ROOT + '/' + to_status + '/' + fn, 'w') as f:
-            json.dump(new_content, f, indent=4)
+        timeline.finished(new_content, from_status, to_status)
+    if new_content is not None:
+        # Update it where it is first, then move it, so it is only ever in one status.
+        # If we die in between it stays in the old status with the new content.
+        writeItem(from_status, fn, new_content)
+    os.rename(QUEUE_ROOT + '/' + from_status + '/' + fn, QUEUE_ROOT + '/' + to_status + '/' + fn)
+
+def writeItem(status, fn, item):
+    # Not in the status directory, so nothing reading the queue can see it half written
+    tmp_file = QUEUE_ROOT + '/.' + fn + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(item, f, indent=4)
+    os.replace(tmp_file, QUEUE_ROOT + '/' + status + '/' + fn)
+
+def rewriteItem(did, status, new_content):
+    # Replace an item without moving it
+    writeItem(status, hashedName(did), new_content)
+
+def depth(status):
+    return len(os.listdir(QUEUE_ROOT + '/' + status))
 
 def readNext(status):
     items = os.listdir(QUEUE_ROOT + '/' + status)
     if len(items) == 0:
         return None
     with open(QUEUE_ROOT + '/' + status + '/' + items[0]) as f:
-        return json.load(f)
+        item = json.load(f)
+    timeline.claimed(item, status)
+    return item
 
-def readItem(at_uri, bot, status):
-    fn = hashedName(at_uri, bot)
+def iterItems(status):
+    # Everything with the status, without claiming it
+    for fn in os.listdir(QUEUE_ROOT + '/' + status):
+        with open(QUEUE_ROOT + '/' + status + '/' + fn) as f:
+            yield json.load(f)
+
+def readItems(status, limit):
+    # Up to limit items with the status, for handling in a batch
+    ret = []
+    for fn in os.listdir(QUEUE_ROOT + '/' + status)[0:limit]:
+        with open(QUEUE_ROOT + '/' + status + '/' + fn) as f:
+            item = json.load(f)
+        timeline.claimed(item, status)
+        ret.append(item)
+    return ret
+
+def readItem(did, status):
+    fn = hashedName(did)
     with open(QUEUE_ROOT + '/' + status + '/' + fn) as f:
         return json.load(f)
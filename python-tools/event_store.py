@@ -0,0 +1,78 @@
+# Append-only log of the contract events we care about, with an index so we can look things up without loading it all.
+
+# Every event is stored once with the key you'll want to look it up by, eg the content hash or the DID.
+# Rows are never updated or deleted, so a rescan of the same blocks just finds they're already there.
+# It's an SQLite file so we get the indexes and atomic appends for free.
+
+import sqlite3
+import json
+
+STORE_FILE = 'event_store.sqlite'
+
+# Used for entries we imported from the old JSON files, which didn't record where in the block they came from
+UNKNOWN_LOG_INDEX = -1
+
+conn = None
+
+def connection():
+    global conn
+    if conn is None:
+        conn = sqlite3.connect(STORE_FILE)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                event TEXT NOT NULL,
+                key TEXT NOT NULL,
+                block INTEGER NOT NULL,
+                log_index INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                UNIQUE (event, key, block, log_index)
+            );
+            CREATE INDEX IF NOT EXISTS events_by_key ON events (event, key, block);
+            CREATE INDEX IF NOT EXISTS events_by_block ON events (event, block, log_index);
+        """)
+    return conn
+
+def append(event, key, block, log_index, data):
+    connection().execute(
+        'INSERT OR IGNORE INTO events (event, key, block, log_index, data) VALUES (?, ?, ?, ?, ?)',
+        (event, key, block, log_index, json.dumps(data))
+    )
+
+def commit():
+    connection().commit()
+
+def count(event):
+    cur = connection().execute('SELECT count(*) FROM events WHERE event = ?', (event,))
+    return cur.fetchone()[0]
+
+def lookup(event, key):
+    # The most recent data recorded for the key, or None
+    cur = connection().execute(
+        'SELECT data FROM events WHERE event = ? AND key = ? ORDER BY block DESC, log_index DESC LIMIT 1',
+        (event, key)
+    )
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+def scan(event, from_block=None, to_block=None):
+    # Yields (key, block, data) in block order
+    sql = 'SELECT key, block, data FROM events WHERE event = ?'
+    params = [event]
+    if from_block is not None:
+        sql = sql + ' AND block >= ?'
+        params.append(from_block)
+    if to_block is not None:
+        sql = sql + ' AND block <= ?'
+        params.append(to_block)
+    sql = sql + ' ORDER BY block, log_index'
+    for row in connection().execute(sql, params):
+        yield row[0], row[1], json.loads(row[2])
+
+def latestBlockByKey(event):
+    # Yields (key, latest block) for each key with the event
+    for row in connection().execute('SELECT key, max(block) FROM events WHERE event = ? GROUP BY key', (event,)):
+        yield row[0], row[1]
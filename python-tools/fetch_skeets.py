@@ -1,29 +1,191 @@
 import os
-from atproto import Client
+from atproto import Client, models
 from dotenv import load_dotenv
 import json
+import threading
+import time
+import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import skeet_queue
+import skeet_classifier
+import bot_registry
+import metrics
 
 skeet_queue.prepare()
 
-parsers = {}
-with open('parser_config.json') as f:
-    parsers = json.load(f)
-
 load_dotenv(dotenv_path='.env')
 
 BSKY_SEARCH_API_USER = os.getenv('BSKY_SEARCH_API_USER')
 BSKY_SEARCH_API_KEY = os.getenv('BSKY_SEARCH_API_KEY')
 
-client = Client()
-profile = client.login(BSKY_SEARCH_API_USER, BSKY_SEARCH_API_KEY)
-print('Welcome,', profile.display_name)
-
-for handle in parsers:
-    posts = client.app.bsky.feed.search_posts({"q": handle})
-    for p in posts['posts']:
-        status = skeet_queue.status(p.uri, handle)
-        if status is None:
-            skeet_queue.queueForPayload(p.uri, handle)
-            print("Queued: "+p.uri + " (" + handle + ") ")
+# Newest indexedAt we have seen for each handle, so each run only asks for what is new,
+# and any ranges we didn't get all the way through last time
+WATERMARK_FILE = 'fetch_watermarks.json'
+
+# Search API limits. We query handles in parallel but space requests out across all threads.
+SEARCH_CONCURRENCY = int(os.getenv('SEARCH_CONCURRENCY', 4))
+SEARCH_REQUESTS_PER_SEC = float(os.getenv('SEARCH_REQUESTS_PER_SEC', 5))
+SEARCH_PAGE_SIZE = 100
+
+# Stop paging after this many pages, mostly relevant to the first run for a handle with no watermark
+SEARCH_MAX_PAGES = int(os.getenv('SEARCH_MAX_PAGES', 50))
+
+# How far before the watermark to search from. The search API's since filter goes by sortAt, the earlier of
+# createdAt and indexedAt, so a post whose client gave it a createdAt a little early can be indexed after the
+# watermark but sort before it. Anything found twice is skipped by skeet_queue.isSeen().
+SEARCH_SINCE_MARGIN_SECS = int(os.getenv('SEARCH_SINCE_MARGIN_SECS', 600))
+
+rate_lock = threading.Lock()
+next_request_at = 0
+
+def waitForRateLimit():
+    global next_request_at
+    with rate_lock:
+        now = time.time()
+        wait = next_request_at - now
+        next_request_at = max(now, next_request_at) + 1.0 / SEARCH_REQUESTS_PER_SEC
+    if wait > 0:
+        time.sleep(wait)
+
+def loadWatermarks():
+    # handle -> {"watermark": newest indexedAt seen, "gaps": ranges we still have to page back through}
+    if not os.path.exists(WATERMARK_FILE):
+        return {}
+    with open(WATERMARK_FILE) as f:
+        watermarks = json.load(f)
+    # Older files only had the watermark
+    for handle in watermarks:
+        if not isinstance(watermarks[handle], dict):
+            watermarks[handle] = {"watermark": watermarks[handle], "gaps": []}
+    return watermarks
+
+def saveWatermarks(watermarks):
+    tmp_file = WATERMARK_FILE + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(watermarks, f, indent=4)
+    os.replace(tmp_file, WATERMARK_FILE)
+
+def isReplyParentNeeded(handle):
+    return bool(bot_registry.metadata(handle).get('reply', False))
+
+def withMargin(watermark):
+    # The watermark moved back by SEARCH_SINCE_MARGIN_SECS, in the same format the API gives us indexedAt in
+    if watermark is None:
+        return None
+    t = datetime.datetime.fromisoformat(watermark.replace('Z', '+00:00')) - datetime.timedelta(seconds=SEARCH_SINCE_MARGIN_SECS)
+    return t.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+def pageBack(client, handle, since, cursor, max_pages):
+    # Pages back through the latest results from the cursor (or the start) until we get to since, less the margin.
+    # Returns the posts found, how many pages it took, and the cursor to carry on from if it ran out of pages first.
+    since = withMargin(since)
+    params = {
+        "q": handle,
+        "sort": "latest",
+        "limit": SEARCH_PAGE_SIZE
+    }
+    if since is not None:
+        params['since'] = since
+    if cursor is not None:
+        params['cursor'] = cursor
+
+    found = []
+    pages = 0
+    while pages < max_pages:
+        waitForRateLimit()
+        with metrics.timer('pds_request_seconds', {"call": "searchPosts"}):
+            res = client.app.bsky.feed.search_posts(params)
+        pages = pages + 1
+
+        is_caught_up = False
+        for p in res.posts:
+            # Results come newest sortAt first, and sortAt is never after indexedAt, so once we're past since so is everything after.
+            # since is inclusive, so anything at it gets checked against the queue again.
+            if since is not None and p.indexed_at < since:
+                is_caught_up = True
+                continue
+            found.append(p)
+
+        if is_caught_up or res.cursor is None or len(res.posts) == 0:
+            return found, pages, None
+        params['cursor'] = res.cursor
+
+    return found, pages, params['cursor']
+
+def searchSince(client, handle, state):
+    # Returns posts we haven't looked at yet, and the new state for the handle.
+    # If there are more new posts than SEARCH_MAX_PAGES will get through, the ones between the old watermark and the
+    # oldest we reached are kept as a gap, with the cursor to carry on from, and we work through it on later runs.
+    watermark = state.get('watermark')
+    gaps = list(state.get('gaps', []))
+
+    found, pages, cursor = pageBack(client, handle, watermark, None, SEARCH_MAX_PAGES)
+    newest = watermark
+    for p in found:
+        if newest is None or p.indexed_at > newest:
+            newest = p.indexed_at
+    # With no watermark there's nothing we said we'd cover, so we just start from what we got
+    if cursor is not None and watermark is not None:
+        print("Stopped paging for " + handle + " after " + str(pages) + " pages, will carry on next time")
+        gaps.append({"since": watermark, "cursor": cursor})
+
+    remaining_gaps = []
+    for gap in gaps:
+        if pages >= SEARCH_MAX_PAGES:
+            remaining_gaps.append(gap)
+            continue
+        try:
+            gap_found, gap_pages, gap_cursor = pageBack(client, handle, gap['since'], gap['cursor'], SEARCH_MAX_PAGES - pages)
+        except Exception as err:
+            # Don't lose the new posts we already found, try the gap again next time
+            print("Search failed for " + handle + " while filling a gap: " + str(err))
+            remaining_gaps.append(gap)
+            continue
+        found.extend(gap_found)
+        pages = pages + gap_pages
+        if gap_cursor is not None:
+            remaining_gaps.append({"since": gap['since'], "cursor": gap_cursor})
+
+    return found, {"watermark": newest, "gaps": remaining_gaps}
+
+if __name__ == '__main__':
+
+    client = Client()
+    profile = client.login(BSKY_SEARCH_API_USER, BSKY_SEARCH_API_KEY)
+    print('Welcome,', profile.display_name)
+
+    watermarks = loadWatermarks()
+
+    with ThreadPoolExecutor(max_workers=SEARCH_CONCURRENCY) as executor:
+        futures = {}
+        for handle in bot_registry.bots():
+            futures[handle] = executor.submit(searchSince, client, handle, watermarks.get(handle, {}))
+
+        # Queue from the main thread so only one thread touches the queue directories
+        for handle in futures:
+            try:
+                posts, new_state = futures[handle].result()
+            except Exception as err:
+                # Leave the watermark alone so we try the same range again next time
+                print("Search failed for " + handle + ": " + str(err))
+                continue
+
+            for p in posts:
+                if skeet_queue.isSeen(p.uri, handle):
+                    continue
+                record = models.get_model_as_dict(p.record)
+                reason = skeet_classifier.classifyRecord(handle, record, isReplyParentNeeded(handle))
+                if reason is not None:
+                    skeet_queue.markIgnored(p.uri, handle, reason)
+                    print("Ignored: "+p.uri + " (" + handle + "): " + reason)
+                    continue
+                reply_parent_uri = None
+                if 'reply' in record and record['reply'] is not None and 'parent' in record['reply']:
+                    reply_parent_uri = record['reply']['parent']['uri']
+                skeet_queue.queueForPayload(p.uri, handle, reply_parent_uri)
+                print("Queued: "+p.uri + " (" + handle + ") ")
+
+            watermarks[handle] = new_state
+
+    saveWatermarks(watermarks)
@@ -1,73 +1,48 @@
-import web3
-from eth_account import Account
 import os
 import json
-import time
-import sys
 
-import hashlib
+import event_store
 
-import skeet_queue
+# atproto accounts that have been active on the SkeetGateway, looked up by DID.
+# The logs are scanned by index_events.py, which calls handleEvent for each LogHandleAccount.
+# They're stored in event_store, so we only ever append the new ones.
 
-from dotenv import load_dotenv
+EVENT_NAME = 'LogHandleAccount'
 
-load_dotenv(dotenv_path='../contract/.env')
-
-url = os.getenv('SEPOLIA_RPC_URL')
-w3 = web3.Web3(web3.HTTPProvider(url))
-
-GATEWAY_ADDRESS = os.getenv('SKEET_GATEWAY')
-DEPLOYMENT_BLOCK = os.getenv('DEPLOYMENT_BLOCK')
-print("DEPLOYMENT_BLOCK is "+str(DEPLOYMENT_BLOCK))
-
-ABI_FILE = "../contract/out/SkeetGateway.sol/SkeetGateway.json"
-ACCOUNT = Account.from_key(os.getenv('PRIVATE_KEY'))
-
-with open(ABI_FILE) as f:
-    d = json.load(f)
-
-GATEWAY_ABI = d['abi']
-
-gateway = w3.eth.contract(address=GATEWAY_ADDRESS, abi=GATEWAY_ABI)
-
-tx_hist = {
-    "lastBlock": DEPLOYMENT_BLOCK,
-    "didByLatestBlock": {}
-}
-print(tx_hist)
+EVENT_NAMES = [EVENT_NAME]
 
+# Where we used to keep the whole history, imported the first time we run
 TX_FILE = "did_hist.json"
 
-if __name__ == '__main__':
-
-    if os.path.exists(TX_FILE):
-        with open(TX_FILE) as f:
-            tx_hist = json.load(f) 
-
-    latest_block = w3.eth.block_number
-    block_number = int(tx_hist['lastBlock'])
-    countLoaded = 0
-    while block_number < latest_block:
-        from_block = block_number
-        to_block = block_number + 999
-        if to_block > latest_block:
-            to_block = latest_block
-        block_number = to_block
+def hasState():
+    return os.path.exists(event_store.STORE_FILE)
+
+def load():
+    if event_store.count(EVENT_NAME) > 0 or not os.path.exists(TX_FILE):
+        return
+    with open(TX_FILE) as f:
+        tx_hist = json.load(f) 
+    for did in tx_hist['didByLatestBlock']:
+        event_store.append(EVENT_NAME, did, tx_hist['didByLatestBlock'][did], event_store.UNKNOWN_LOG_INDEX, {})
+    event_store.commit()
+    print("imported " + str(len(tx_hist['didByLatestBlock'])) + " entries from " + TX_FILE)
+
+def handleEvent(log):
+    did = log['args']['did'].decode('utf-8')
+    event_store.append(EVENT_NAME, did, log['blockNumber'], log['logIndex'], {
+        "account": "0x"+log['args']['account'].hex(),
+        "signer": log['args']['signer'],
+        "txid": log['transactionHash'].to_0x_hex()
+    })
+
+def save(last_block):
+    event_store.commit()
+
+def didByLatestBlock():
+    # Yields each active DID and the latest block we saw it in
+    return event_store.latestBlockByKey(EVENT_NAME)
 
-        isFound = False
-        # print("fetch range "+str(from_block) + "-" + str(to_block))
-        logs = gateway.events.LogHandleAccount().get_logs(from_block=from_block, to_block = to_block)
-        for log in logs:
-            did = log['args']['did'].decode('utf-8')
-            block_num = log['blockNumber']
-            if did not in tx_hist or tx_hist[did] < block_num:
-                tx_hist["didByLatestBlock"][did] = block_num
-            countLoaded = countLoaded + 1
-            isFound = True
-
-        if isFound:
-            print("handled "+str(countLoaded) + " did log entries")
-
-    tx_hist['lastBlock'] = block_number
-    with open(TX_FILE, 'w', encoding='utf-8') as f:
-        json.dump(tx_hist, f, ensure_ascii=False, indent=4)
+if __name__ == '__main__':
+    # All the gateway events are scanned in one pass, so this updates the other handlers too
+    import index_events
+    index_events.run()
@@ -1,18 +1,29 @@
 #!/bin/bash -x
 
-# Only need to run this after deploying a bot
-# python load_bots.py
+# Updates parser_config.json and event_store.sqlite from the contract logs
+python index_events.py
+
+# Put any failed items that are due for another try back in their queues
+python retry_queue.py
 
 python fetch_skeets.py 
 python prepare_payload.py 
 python send_tx.py 
 python report_tx.py
 
-python find_active_dids.py 
-python watch_did_update.py 
+# Use the Postgres PLC mirror if we have one, otherwise follow the plc.directory export
+if [ -f .plc_env ]; then
+    python watch_did_update.py 
+    # clear DID history cache
+    rm -f plcs/*
+else
+    # This keeps the cached history up to date with the operations it sees, so we don't clear it
+    python tail_plc_export.py
+fi
 
-# clear DID history cache
-rm -f plcs/*
 python prepare_did_update.py 
 
 python send_did_tx.py
+
+# Move old completed and ignored skeets into the archive
+python compact_queue.py
@@ -0,0 +1,120 @@
+# Scans the SkeetGateway and ShadowDIDPLCDirectory logs once and hands each event to whichever scripts care about it.
+
+# We ask for every event topic from both contracts in a single eth_getLogs filter per block range,
+# so adding another kind of event to watch doesn't add more log scanning.
+# All the handlers share one watermark in event_index.json, the last block we have scanned up to.
+
+# Each handler module has:
+#   EVENT_NAMES: The events it wants
+#   hasState(): False if its state is missing, so we need to scan everything again from DEPLOYMENT_BLOCK
+#   load(): Read its existing state
+#   handleEvent(event): Apply a decoded event, called in block order
+#   save(last_block): Write its state out
+
+import os
+import json
+
+from web3._utils.events import get_event_data
+
+import log_scanner
+import clients
+
+import tx_history
+import find_active_dids
+import load_bots
+
+ABI_FILES = [
+    clients.GATEWAY_ABI_FILE,
+    clients.SHADOW_DID_ABI_FILE,
+]
+
+STATE_FILE = "event_index.json"
+
+HANDLERS = [tx_history, find_active_dids, load_bots]
+
+def eventsByTopic():
+    events_by_topic = {}
+    for abi_file in ABI_FILES:
+        for entry in clients.abi(abi_file):
+            if entry['type'] != 'event':
+                continue
+            inputs = ",".join([param["type"] for param in entry["inputs"]])
+            event_signature_text = entry['name'] + "(" + inputs + ")"
+            topic = "0x" + clients.w3().keccak(text=event_signature_text).hex()
+            events_by_topic[topic] = entry
+    return events_by_topic
+
+def loadState():
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    return {
+        "lastBlock": clients.config('DEPLOYMENT_BLOCK')
+    }
+
+def saveState(state):
+    tmp_file = STATE_FILE + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp_file, STATE_FILE)
+
+def run():
+    w3 = clients.w3()
+    events_by_topic = eventsByTopic()
+
+    state = loadState()
+    handlers_by_event = {}
+    for handler in HANDLERS:
+        if not handler.hasState():
+            # Handlers ignore anything they've already seen, so the others don't mind seeing it again
+            print(handler.__name__ + " has no state, scanning from the deployment block")
+            state['lastBlock'] = clients.config('DEPLOYMENT_BLOCK')
+        handler.load()
+        for name in handler.EVENT_NAMES:
+            if name not in handlers_by_event:
+                handlers_by_event[name] = []
+            handlers_by_event[name].append(handler)
+
+    addresses = [clients.gatewayAddress()]
+    # env.example leaves SHADOW_DID empty if you don't have one
+    if clients.shadowDidAddress():
+        addresses.append(clients.shadowDidAddress())
+
+    def fetch(from_block, to_block):
+        return w3.eth.get_logs({
+            "address": addresses,
+            "fromBlock": from_block,
+            "toBlock": to_block,
+            # A list in the first position means any of these topics
+            "topics": [list(events_by_topic.keys())]
+        })
+
+    latest_block = w3.eth.block_number
+    block_number = int(state['lastBlock'])
+    count_by_event = {}
+
+    for from_block, to_block, logs in log_scanner.scanLogs(fetch, block_number, latest_block):
+        for log in logs:
+            topic = log['topics'][0].to_0x_hex()
+            if topic not in events_by_topic:
+                continue
+            event = get_event_data(w3.codec, events_by_topic[topic], log)
+            name = event['event']
+            count_by_event[name] = count_by_event.get(name, 0) + 1
+            for handler in handlers_by_event.get(name, []):
+                handler.handleEvent(event)
+
+        if len(logs) > 0:
+            print("fetched range "+str(from_block) + "-" + str(to_block) + ", events so far: " + str(count_by_event))
+        block_number = to_block
+
+    # Handlers first, so if we die in between we just scan the same blocks again next time
+    for handler in HANDLERS:
+        handler.save(block_number)
+
+    state['lastBlock'] = block_number
+    saveState(state)
+    return count_by_event
+
+if __name__ == '__main__':
+    run()
@@ -1,58 +1,61 @@
-import web3
 import os
 import json
 
-from dotenv import load_dotenv
+# Bots registered with the SkeetGateway, by their full name (subdomain.domain).
+# The logs are scanned by index_events.py, which calls handleEvent for each LogAddBot.
+# It moves forward from the last block it scanned, and hands us the events in block order,
+# so if a name is registered again the later registration wins.
+# We write parser_config.json once at the end, and only if something changed.
+# Other scripts read it through bot_registry, which notices when the file is replaced and reloads it.
 
-load_dotenv(dotenv_path='../contract/.env')
+EVENT_NAMES = ['LogAddBot']
 
-url = os.getenv('SEPOLIA_RPC_URL')
-w3 = web3.Web3(web3.HTTPProvider(url))
-
-GATEWAY_ADDRESS = os.getenv('SKEET_GATEWAY')
-DEPLOYMENT_BLOCK = int(os.getenv('DEPLOYMENT_BLOCK'))
-
-ABI_FILE = "../contract/out/SkeetGateway.sol/SkeetGateway.json"
-
-with open(ABI_FILE) as f:
-    d = json.load(f)
-
-GATEWAY_ABI = d['abi']
-
-gateway_contract = w3.eth.contract(address=GATEWAY_ADDRESS, abi=GATEWAY_ABI)
+PARSER_CONFIG = 'parser_config.json'
 
 parser_config = {}
-
-start_block = w3.eth.block_number
-max_blocks = 100000
-if start_block - DEPLOYMENT_BLOCK > max_blocks:
-    max_blocks = start_block - DEPLOYMENT_BLOCK
-
-print("fetching back to "+str(start_block - max_blocks))
-
-block_number = start_block
-countLoaded = 0
-while block_number > start_block - max_blocks:
-    isFound = False
-    block_number = block_number - 999 
-    print("fetch from "+str(block_number))
-    logs = gateway_contract.events.LogAddBot().get_logs(from_block=block_number, to_block = block_number+999)
-    for log in logs:
-       # AttributeDict({'args': AttributeDict({'parser': '0xA84F9FC27e849f636c18125c74358E003492f437', 'domain': 'unconsensus.com', 'subdomain': 'bbs'}), 'event': 'LogAddBot', 'logIndex': 125, 'transactionIndex': 101, 'transactionHash': HexBytes('0x215cdf64f66304cd3d8116ef85a8447eea814465003153970018ce117449fef1'), 'address ': '0xeB1Ef91e8658FE4b13Cc6A6d8E46c6Dcf5Aa63C1', 'blockHash': HexBytes('0x28353957873746df7ae5c56a9bd6143eb080bc4ead0330e6e37ede4894c1e6e8'), 'blockNumber': 7 351100})                       
-        metadata_arg = log['args']['metadata'];
-        metadata = None
-        if metadata_arg == "":
-            metadata = {}
-        else:
-            metadata = json.loads(metadata_arg)
-        parser_config[log['args']['subdomain'] + '.' + log['args']['domain']] = {
-            "parser": log['args']['parser'],
-            "metadata": metadata
-        }
-        countLoaded = countLoaded + 1
-        isFound = True
-        with open('parser_config.json', 'w', encoding='utf-8') as f:
-            json.dump(parser_config, f, ensure_ascii=False, indent=4)
-
-    if isFound:
-        print("loaded "+str(countLoaded))
+is_changed = False
+
+def hasState():
+    return os.path.exists(PARSER_CONFIG)
+
+def load():
+    global parser_config
+    if os.path.exists(PARSER_CONFIG):
+        with open(PARSER_CONFIG) as f:
+            parser_config = json.load(f)
+
+def handleEvent(log):
+    global is_changed
+    # AttributeDict({'args': AttributeDict({'parser': '0xA84F9FC27e849f636c18125c74358E003492f437', 'domain': 'unconsensus.com', 'subdomain': 'bbs'}), 'event': 'LogAddBot', 'logIndex': 125, 'transactionIndex': 101, 'transactionHash': HexBytes('0x215cdf64f66304cd3d8116ef85a8447eea814465003153970018ce117449fef1'), 'address ': '0xeB1Ef91e8658FE4b13Cc6A6d8E46c6Dcf5Aa63C1', 'blockHash': HexBytes('0x28353957873746df7ae5c56a9bd6143eb080bc4ead0330e6e37ede4894c1e6e8'), 'blockNumber': 7 351100})                       
+    metadata_arg = log['args']['metadata'];
+    metadata = None
+    if metadata_arg == "":
+        metadata = {}
+    else:
+        metadata = json.loads(metadata_arg)
+    bot_name = log['args']['subdomain'] + '.' + log['args']['domain']
+    entry = {
+        "parser": log['args']['parser'],
+        "metadata": metadata
+    }
+    if parser_config.get(bot_name) != entry:
+        parser_config[bot_name] = entry
+        is_changed = True
+        print("loaded bot " + bot_name)
+
+def save(last_block):
+    global is_changed
+    # Write it even with no bots yet, otherwise hasState() stays False and we rescan from the deployment block every run
+    if not is_changed and os.path.exists(PARSER_CONFIG):
+        return
+    # Write to a temporary file then move it into place, so nobody sees a half-written file
+    tmp_file = PARSER_CONFIG + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(parser_config, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_file, PARSER_CONFIG)
+    is_changed = False
+
+if __name__ == '__main__':
+    # All the gateway events are scanned in one pass, so this updates the other handlers too
+    import index_events
+    index_events.run()
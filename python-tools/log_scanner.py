@@ -0,0 +1,118 @@
+# Fetches logs for a block range using several eth_getLogs requests in parallel.
+
+# We start with a window of INITIAL_WINDOW blocks.
+# If a window comes back with few results we make the next ones bigger.
+# If the provider complains about the range or the size of the result we split it in half and try again,
+# and don't go that big again for the rest of the scan.
+# Results are handed back in block order, one window at a time, so the caller can checkpoint as it goes.
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+INITIAL_WINDOW = 999
+
+# Grow the window if we get fewer logs than this back
+SPARSE_RESULTS = 100
+
+# Messages that mean the range or the result was too big, which we fix by asking for less
+RANGE_ERROR_HINTS = [
+    'block range',
+    'range too large',
+    'range is too large',
+    'is limited to',
+    'returned more than',
+    'response size',
+    'exceed maximum',
+    'query timeout',
+]
+
+# Messages that mean we should slow down and try the same thing again
+RATE_LIMIT_HINTS = [
+    '429',
+    'rate limit',
+    'too many requests',
+]
+
+MAX_RATE_LIMIT_RETRIES = 5
+
+def _matches(err, hints):
+    msg = str(err).lower()
+    for h in hints:
+        if h in msg:
+            return True
+    return False
+
+def isRangeError(err):
+    return _matches(err, RANGE_ERROR_HINTS)
+
+def isRateLimitError(err):
+    return _matches(err, RATE_LIMIT_HINTS)
+
+def _fetchWithRetry(fetch, from_block, to_block):
+    attempt = 0
+    while True:
+        try:
+            return fetch(from_block, to_block)
+        except Exception as err:
+            if not isRateLimitError(err) or attempt >= MAX_RATE_LIMIT_RETRIES:
+                raise
+            time.sleep(2 ** attempt)
+            attempt = attempt + 1
+
+def scanLogs(fetch, from_block, to_block, workers=None, max_window=None):
+    # fetch(from_block, to_block) should return the logs for that range, inclusive at both ends.
+    # Yields (from_block, to_block, logs) for consecutive ranges covering the whole scan, in order.
+    if workers is None:
+        workers = int(os.getenv('LOG_SCAN_WORKERS', 4))
+    if max_window is None:
+        max_window = int(os.getenv('LOG_SCAN_MAX_WINDOW', 100000))
+
+    window = min(INITIAL_WINDOW, max_window)
+    next_start = from_block
+    emit_from = from_block
+
+    pending = {}
+    done = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def submit(start, end):
+            pending[executor.submit(_fetchWithRetry, fetch, start, end)] = (start, end)
+
+        while True:
+            while next_start <= to_block and len(pending) < workers:
+                end = min(next_start + window - 1, to_block)
+                submit(next_start, end)
+                next_start = end + 1
+
+            if len(pending) == 0:
+                break
+
+            finished, not_finished = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                start, end = pending.pop(fut)
+                size = end - start + 1
+                try:
+                    logs = fut.result()
+                except Exception as err:
+                    if not isRangeError(err) or size == 1:
+                        raise
+                    # Split this one, and don't ask for anything this big again
+                    max_window = max(1, size // 2)
+                    window = min(window, max_window)
+                    mid = start + size // 2
+                    print("range " + str(start) + "-" + str(end) + " too big, splitting")
+                    submit(start, mid - 1)
+                    submit(mid, end)
+                    continue
+
+                done[start] = (end, logs)
+                if len(logs) < SPARSE_RESULTS and size >= window:
+                    window = min(window * 2, max_window)
+
+            while emit_from in done:
+                end, logs = done.pop(emit_from)
+                logs = sorted(logs, key=lambda l: (l['blockNumber'], l['logIndex']))
+                yield emit_from, end, logs
+                emit_from = end + 1
@@ -0,0 +1,264 @@
+# Counters and timings for the python-tools scripts, so we can see which stage is the bottleneck without tailing logs.
+
+# Each script keeps its numbers in memory and adds them to running totals in metrics/<script>.json when it exits.
+# render() combines the totals with the current queue depths into metrics/metrics.prom, in the Prometheus text format.
+# You can point the node_exporter textfile collector at that directory, or run
+#   python metrics.py --serve 9464
+# to serve it at http://localhost:9464/metrics, freshly rendered on each request.
+
+# Delete the metrics directory to start counting again from zero.
+
+import os
+import sys
+import json
+import time
+import fcntl
+import atexit
+import argparse
+import threading
+import contextlib
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+METRICS_DIR = './metrics'
+PROM_FILE = METRICS_DIR + '/metrics.prom'
+LOCK_FILE = METRICS_DIR + '/.lock'
+
+PREFIX = 'skeet_gateway_'
+
+# Upper bounds in seconds, from a cache-busting RPC call up to a slow transaction confirmation
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+# Not yet added to the totals on disk, by (name, labels)
+counters = {}
+histograms = {}
+
+# Whether this process has recorded anything, so scripts that didn't do anything don't rewrite the file when they exit
+is_recorded = False
+
+# fetch_skeets.py records from several threads
+lock = threading.Lock()
+
+# Functions called with (name, labels, seconds) for everything timed with timer(), eg to record it on a queue item
+listeners = []
+
+def _key(name, labels):
+    if labels is None:
+        return (name, ())
+    return (name, tuple(sorted(labels.items())))
+
+def inc(name, labels=None, amount=1):
+    global is_recorded
+    key = _key(name, labels)
+    with lock:
+        is_recorded = True
+        counters[key] = counters.get(key, 0) + amount
+
+def observe(name, value, labels=None):
+    global is_recorded
+    key = _key(name, labels)
+    with lock:
+        is_recorded = True
+        if key not in histograms:
+            histograms[key] = {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0, "count": 0}
+        h = histograms[key]
+        for i in range(len(LATENCY_BUCKETS)):
+            if value <= LATENCY_BUCKETS[i]:
+                h['buckets'][i] = h['buckets'][i] + 1
+        h['sum'] = h['sum'] + value
+        h['count'] = h['count'] + 1
+
+@contextlib.contextmanager
+def timer(name, labels=None):
+    # Observes how long the block took, whether or not it raised
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        seconds = time.monotonic() - start
+        observe(name, seconds, labels)
+        for listener in listeners:
+            listener(name, labels, seconds)
+
+def cacheResult(cache, is_hit):
+    inc('cache_requests_total', {"cache": cache, "result": "hit" if is_hit else "miss"})
+
+def totalsFile():
+    script = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    if script == '':
+        script = 'python'
+    return METRICS_DIR + '/' + script + '.json'
+
+def loadTotals(totals_file):
+    if not os.path.exists(totals_file):
+        return {"counters": [], "histograms": []}
+    with open(totals_file) as f:
+        return json.load(f)
+
+def flush():
+    # Add what we've recorded since the last flush to the totals on disk.
+    # Worker processes don't run atexit handlers so they need to call this themselves.
+    global counters, histograms
+    with lock:
+        pending_counters = counters
+        pending_histograms = histograms
+        counters = {}
+        histograms = {}
+    if len(pending_counters) == 0 and len(pending_histograms) == 0:
+        return
+
+    if not os.path.exists(METRICS_DIR):
+        os.makedirs(METRICS_DIR, exist_ok=True)
+
+    totals_file = totalsFile()
+    with open(LOCK_FILE, 'w') as lf:
+        # Several processes of the same script may be flushing at once
+        fcntl.flock(lf, fcntl.LOCK_EX)
+        totals = loadTotals(totals_file)
+
+        counter_totals = {_key(c['name'], c['labels']): c['value'] for c in totals['counters']}
+        for key in pending_counters:
+            counter_totals[key] = counter_totals.get(key, 0) + pending_counters[key]
+
+        histogram_totals = {_key(h['name'], h['labels']): h for h in totals['histograms']}
+        for key in pending_histograms:
+            pending = pending_histograms[key]
+            if key not in histogram_totals:
+                histogram_totals[key] = {"name": key[0], "labels": dict(key[1]), "buckets": [0] * len(LATENCY_BUCKETS), "sum": 0, "count": 0}
+            h = histogram_totals[key]
+            h['buckets'] = [h['buckets'][i] + pending['buckets'][i] for i in range(len(LATENCY_BUCKETS))]
+            h['sum'] = h['sum'] + pending['sum']
+            h['count'] = h['count'] + pending['count']
+
+        totals = {
+            "counters": [{"name": key[0], "labels": dict(key[1]), "value": counter_totals[key]} for key in counter_totals],
+            "histograms": list(histogram_totals.values())
+        }
+        tmp_file = totals_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(totals, f, indent=4)
+        os.replace(tmp_file, totals_file)
+
+def discardPending():
+    # Forget what we've recorded since the last flush without adding it to the totals.
+    # Worker processes forked from a script start with a copy of whatever it had recorded, which the script flushes itself.
+    global counters, histograms
+    with lock:
+        counters = {}
+        histograms = {}
+
+def _labelText(labels):
+    if len(labels) == 0:
+        return ''
+    parts = []
+    for name in sorted(labels):
+        value = str(labels[name]).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(name + '="' + value + '"')
+    return '{' + ','.join(parts) + '}'
+
+def queueDepths():
+    # Imported here so recording metrics doesn't pull in the queue modules
+    import skeet_queue
+    import did_queue
+    depths = []
+    for queue_name, queue in [("skeet_queue", skeet_queue), ("did_queue", did_queue)]:
+        for s in queue.statuses:
+            try:
+                depths.append(({"queue": queue_name, "status": s}, queue.depth(s)))
+            except FileNotFoundError:
+                # Nothing has been queued there yet
+                depths.append(({"queue": queue_name, "status": s}, 0))
+    return depths
+
+def renderText():
+    # Everything on disk, added up across scripts
+    counter_totals = {}
+    histogram_totals = {}
+    if os.path.exists(METRICS_DIR):
+        for fn in sorted(os.listdir(METRICS_DIR)):
+            if not fn.endswith('.json'):
+                continue
+            totals = loadTotals(METRICS_DIR + '/' + fn)
+            for c in totals['counters']:
+                key = _key(c['name'], c['labels'])
+                counter_totals[key] = counter_totals.get(key, 0) + c['value']
+            for h in totals['histograms']:
+                key = _key(h['name'], h['labels'])
+                if key not in histogram_totals:
+                    histogram_totals[key] = {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0, "count": 0}
+                t = histogram_totals[key]
+                t['buckets'] = [t['buckets'][i] + h['buckets'][i] for i in range(len(LATENCY_BUCKETS))]
+                t['sum'] = t['sum'] + h['sum']
+                t['count'] = t['count'] + h['count']
+
+    lines = []
+
+    lines.append('# TYPE ' + PREFIX + 'queue_depth gauge')
+    for labels, depth in queueDepths():
+        lines.append(PREFIX + 'queue_depth' + _labelText(labels) + ' ' + str(depth))
+
+    typed = set()
+    for key in sorted(counter_totals):
+        name = PREFIX + key[0]
+        if name not in typed:
+            lines.append('# TYPE ' + name + ' counter')
+            typed.add(name)
+        lines.append(name + _labelText(dict(key[1])) + ' ' + str(counter_totals[key]))
+
+    for key in sorted(histogram_totals):
+        name = PREFIX + key[0]
+        labels = dict(key[1])
+        h = histogram_totals[key]
+        if name not in typed:
+            lines.append('# TYPE ' + name + ' histogram')
+            typed.add(name)
+        # Buckets are already cumulative, each one counts everything up to its bound
+        for i in range(len(LATENCY_BUCKETS)):
+            lines.append(name + '_bucket' + _labelText(dict(labels, le=str(LATENCY_BUCKETS[i]))) + ' ' + str(h['buckets'][i]))
+        lines.append(name + '_bucket' + _labelText(dict(labels, le='+Inf')) + ' ' + str(h['count']))
+        lines.append(name + '_sum' + _labelText(labels) + ' ' + str(h['sum']))
+        lines.append(name + '_count' + _labelText(labels) + ' ' + str(h['count']))
+
+    return "\n".join(lines) + "\n"
+
+def render():
+    if not os.path.exists(METRICS_DIR):
+        os.makedirs(METRICS_DIR, exist_ok=True)
+    text = renderText()
+    tmp_file = PROM_FILE + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(text)
+    os.replace(tmp_file, PROM_FILE)
+
+def _flushAndRender():
+    if not is_recorded:
+        return
+    flush()
+    render()
+
+atexit.register(_flushAndRender)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = renderText().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--serve", type=int, help="port to serve the metrics on, instead of printing them")
+    args = parser.parse_args()
+
+    if args.serve is None:
+        print(renderText(), end='')
+        sys.exit(0)
+
+    print("Serving metrics on http://localhost:" + str(args.serve) + "/metrics")
+    HTTPServer(('localhost', args.serve), MetricsHandler).serve_forever()
@@ -0,0 +1,74 @@
+# Helpers for batching several contract calls into one with Multicall3.
+
+# Multicall3 is deployed at the same address on Sepolia, mainnet and most other chains.
+# See https://github.com/mds1/multicall
+# If you're running against a fresh local anvil it won't be there unless you fork from a chain that has it,
+# so check isAvailable() and fall back to making the calls one at a time.
+
+import os
+
+# Set MULTICALL3 in the environment to use a different one
+DEFAULT_MULTICALL3_ADDRESS = '0xcA11bde05977b3631167028862bE2a173976CA11'
+
+MULTICALL3_ABI = [
+    {
+        "type": "function",
+        "name": "aggregate3",
+        "stateMutability": "payable",
+        "inputs": [
+            {
+                "name": "calls",
+                "type": "tuple[]",
+                "components": [
+                    {"name": "target", "type": "address"},
+                    {"name": "allowFailure", "type": "bool"},
+                    {"name": "callData", "type": "bytes"}
+                ]
+            }
+        ],
+        "outputs": [
+            {
+                "name": "returnData",
+                "type": "tuple[]",
+                "components": [
+                    {"name": "success", "type": "bool"},
+                    {"name": "returnData", "type": "bytes"}
+                ]
+            }
+        ]
+    }
+]
+
+# Error(string), which is what require() reverts with
+ERROR_SELECTOR = bytes.fromhex('08c379a0')
+
+def address():
+    return os.getenv('MULTICALL3', DEFAULT_MULTICALL3_ADDRESS)
+
+def contract(w3):
+    return w3.eth.contract(address=address(), abi=MULTICALL3_ABI)
+
+def isAvailable(w3):
+    return len(w3.eth.get_code(address())) > 0
+
+def encodeCall(target_contract, fn_name, args, allow_failure=True):
+    return (target_contract.address, allow_failure, target_contract.encode_abi(fn_name, args=args))
+
+def aggregate(w3, calls):
+    # Make the calls in a single eth_call, returning a list of (success, returnData)
+    return contract(w3).functions.aggregate3(calls).call()
+
+def decodeResult(target_contract, fn_name, return_data):
+    # Decode what a successful call returned, as the function would have returned it
+    fn = target_contract.get_function_by_name(fn_name)
+    output_types = [o['type'] for o in fn.abi['outputs']]
+    decoded = target_contract.w3.codec.decode(output_types, return_data)
+    if len(decoded) == 1:
+        return decoded[0]
+    return decoded
+
+def revertReason(w3, return_data):
+    # Turn what a failed call returned into something readable, like we would get from a ContractLogicError
+    if return_data[0:4] == ERROR_SELECTOR:
+        return 'execution reverted: ' + w3.codec.decode(['string'], return_data[4:])[0]
+    return 'execution reverted: 0x' + return_data.hex()
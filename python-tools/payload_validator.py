@@ -0,0 +1,343 @@
+# Checks a payload the same way SkeetGateway.handleSkeet() will, without touching the chain.
+# send_tx.py runs this first, so a payload that is going to revert fails without spending RPC calls or gas.
+
+# This follows AtprotoMSTProver.sol, DagCborNavigator.sol and SkeetGateway.sol step by step, and fails with the same
+# messages as the contract's require()s where it has one.
+# Anything wrong with the payload itself raises InvalidPayload, which send_tx.py tells retry_queue not to retry.
+# The contract's assert()s on badly-formed CBOR come out here as "Malformed CBOR".
+# If you change how the contracts parse things, change this too.
+
+# It doesn't check anything that depends on chain state, like whether the message was already handled,
+# or what the bot's parser thinks of the message.
+# Bots are looked up in parser_config.json, which index_events.py keeps up to date from the contract.
+
+# Run it on payload files to check them:
+#   python payload_validator.py ../contract/test/fixtures/answer.json
+
+import sys
+import json
+import hashlib
+
+from eth_keys import KeyAPI
+from eth_keys.exceptions import BadSignature, ValidationError
+
+import bot_registry
+
+# Tag 42 (CID), 37 bytes of bytes, then the multibase 0 and the CIDv1 dag-cbor sha2-256 prefix
+CID_PREFIX = bytes.fromhex('d82a58250001711220')
+CBOR_NULL = 0xf6
+
+CBOR_MAPPING_2_ENTRIES = 0xa2
+CBOR_MAPPING_15_ENTRIES = 0xaf
+CBOR_HEADER_TEXT = bytes.fromhex('6474657874') # text, "text"
+
+APP_BSKY_FEED_POST = b'app.bsky.feed.post'
+
+class InvalidPayload(Exception):
+    # The payload itself is wrong, so it will fail the same way however many times we try it
+    pass
+
+def malformed(cursor, detail):
+    return InvalidPayload("Malformed CBOR at byte " + str(cursor) + ": " + detail)
+
+def take(cbor, cursor, length):
+    # Like slicing calldata, which reverts if you go off the end
+    if cursor + length > len(cbor):
+        raise malformed(cursor, "expected " + str(length) + " more bytes but the data ends")
+    return cbor[cursor:cursor + length]
+
+def parseCborHeader(cbor, cursor):
+    first = take(cbor, cursor, 1)[0]
+    cursor = cursor + 1
+    maj = first >> 5
+    low = first & 0x1f
+
+    if maj == 6:
+        # CID is the only tag DAG-CBOR allows
+        if take(cbor, cursor, 3) != bytes.fromhex('2a5825'):
+            raise InvalidPayload("Unsupported tag or unexpected CID header bytes")
+        return (maj, 37, cursor + 3)
+
+    if low < 24:
+        return (maj, low, cursor)
+    extra_bytes = {24: 1, 25: 2, 26: 4, 27: 8}
+    if low not in extra_bytes:
+        raise InvalidPayload("cannot handle headers with extra > 27")
+    extra = int.from_bytes(take(cbor, cursor, extra_bytes[low]), byteorder='big')
+    return (maj, extra, cursor + extra_bytes[low])
+
+def expectMajor(cbor, cursor, expected_maj):
+    (maj, extra, next_cursor) = parseCborHeader(cbor, cursor)
+    if maj != expected_maj:
+        raise malformed(cursor, "expected major type " + str(expected_maj) + " but found " + str(maj))
+    return (extra, next_cursor)
+
+def extractCBORInteger(cbor, cursor):
+    return expectMajor(cbor, cursor, 0)
+
+def extractCBORArrayLength(cbor, cursor):
+    return expectMajor(cbor, cursor, 4)
+
+def extractCBORBytes(cbor, cursor):
+    (length, cursor) = expectMajor(cbor, cursor, 2)
+    return (take(cbor, cursor, length), cursor + length)
+
+def extractCBORString(cbor, cursor):
+    (length, cursor) = expectMajor(cbor, cursor, 3)
+    return (take(cbor, cursor, length), cursor + length)
+
+def ignoreCBORString(cbor, cursor):
+    return extractCBORString(cbor, cursor)[1]
+
+def expectCBORInteger(cbor, cursor, n):
+    (value, next_cursor) = extractCBORInteger(cbor, cursor)
+    if value != n:
+        raise malformed(cursor, "expected integer " + str(n) + " but found " + str(value))
+    return next_cursor
+
+def expectCBORMapping(cbor, cursor, n):
+    if n < 24:
+        if take(cbor, cursor, 1)[0] != 0xa0 + n:
+            raise malformed(cursor, "expected a mapping with " + str(n) + " entries")
+        return cursor + 1
+    (extra, next_cursor) = expectMajor(cbor, cursor, 5)
+    if extra != n:
+        raise malformed(cursor, "expected a mapping with " + str(n) + " entries but found " + str(extra))
+    return next_cursor
+
+def expectCBORTextField(cbor, cursor, name):
+    header = bytes([0x60 + len(name)]) + name.encode('utf-8')
+    if take(cbor, cursor, len(header)) != header:
+        raise malformed(cursor, "expected field " + name)
+    return cursor + len(header)
+
+def ignoreCBORTextField1(cursor):
+    # The contract skips these field names without looking at them, so we don't either
+    return cursor + 2
+
+def extractCBORCID(cbor, cursor):
+    if take(cbor, cursor, len(CID_PREFIX)) != CID_PREFIX:
+        raise malformed(cursor, "expected a CID")
+    cursor = cursor + len(CID_PREFIX)
+    return (take(cbor, cursor, 32), cursor + 32)
+
+def extractCBORNullableCID(cbor, cursor):
+    if take(cbor, cursor, 1)[0] == CBOR_NULL:
+        return (None, cursor + 1)
+    return extractCBORCID(cbor, cursor)
+
+def ignoreCBORNullableCID(cbor, cursor):
+    return extractCBORNullableCID(cbor, cursor)[1]
+
+def ignoreCBORCID(cursor):
+    return cursor + len(CID_PREFIX) + 32
+
+def indexOfFieldPayloadEnd(cbor, cursor):
+    (maj, extra, cursor) = parseCborHeader(cbor, cursor)
+    if maj == 2 or maj == 3 or maj == 6:
+        return cursor + extra
+    if maj == 0 or maj == 1 or maj == 7:
+        return cursor
+    # For a map there's a key and a value for each entry
+    num_entries = extra * 2 if maj == 5 else extra
+    for i in range(num_entries):
+        cursor = indexOfFieldPayloadEnd(cbor, cursor)
+    return cursor
+
+def indexOfMappingField(cbor, field_header, cursor):
+    end_index = len(cbor) - len(field_header)
+    while cursor < end_index:
+        if cbor[cursor:cursor + len(field_header)] == field_header:
+            return cursor + len(field_header)
+        # field for the name, then field for the value
+        cursor = indexOfFieldPayloadEnd(cbor, cursor)
+        cursor = indexOfFieldPayloadEnd(cbor, cursor)
+    raise InvalidPayload("fieldHeader not found")
+
+def indexOfMessageText(content):
+    # Returns the start and end of the text field of the post
+    mapping_byte = take(content, 0, 1)[0]
+    if mapping_byte < CBOR_MAPPING_2_ENTRIES or mapping_byte > CBOR_MAPPING_15_ENTRIES:
+        raise malformed(0, "expected a mapping with 2 to 15 entries")
+    cursor = indexOfMappingField(content, CBOR_HEADER_TEXT, 1)
+    (maj, length, cursor) = parseCborHeader(content, cursor)
+    return (cursor, cursor + length)
+
+def processCommitNode(prove_me, commit_node):
+    # Returns the DID the commit node claims to be for
+    cursor = expectCBORMapping(commit_node, 0, 5)
+
+    cursor = expectCBORTextField(commit_node, cursor, "did")
+    (did, cursor) = extractCBORString(commit_node, cursor)
+
+    cursor = expectCBORTextField(commit_node, cursor, "rev")
+    cursor = ignoreCBORString(commit_node, cursor)
+
+    cursor = expectCBORTextField(commit_node, cursor, "data")
+    (found_cid, cursor) = extractCBORCID(commit_node, cursor)
+    if found_cid != prove_me:
+        raise InvalidPayload("Data field does not contain expected hash")
+
+    cursor = expectCBORTextField(commit_node, cursor, "prev")
+    cursor = ignoreCBORNullableCID(commit_node, cursor)
+
+    cursor = expectCBORTextField(commit_node, cursor, "version")
+    cursor = expectCBORInteger(commit_node, cursor, 3)
+
+    return did.decode('utf-8', errors='replace')
+
+def verifyDataNode(node, prove_me):
+    # Returns the hash of the node, the record key of the entry with our hash, and its hint
+    cursor = expectCBORMapping(node, 0, 2)
+    cursor = expectCBORTextField(node, cursor, "e")
+    (num_entries, cursor) = extractCBORArrayLength(node, cursor)
+
+    # Each entry keeps the first p bytes of the previous record key and adds k
+    rkey = b''
+    for i in range(num_entries):
+        cursor = expectCBORMapping(node, cursor, 4)
+
+        cursor = expectCBORTextField(node, cursor, "k")
+        (kval, cursor) = extractCBORBytes(node, cursor)
+
+        cursor = expectCBORTextField(node, cursor, "p")
+        (bytes_reused, cursor) = extractCBORInteger(node, cursor)
+        if bytes_reused > len(rkey):
+            raise malformed(cursor, "p is longer than the previous key")
+        rkey = rkey[0:bytes_reused] + kval
+
+        cursor = expectCBORTextField(node, cursor, "t")
+        cursor = ignoreCBORNullableCID(node, cursor)
+
+        cursor = expectCBORTextField(node, cursor, "v")
+        (found_cid, cursor) = extractCBORCID(node, cursor)
+        if found_cid == prove_me:
+            return (hashlib.sha256(node).digest(), rkey, i + 1)
+
+    raise InvalidPayload("Target entry not found in data node")
+
+def verifyTreeNode(node, prove_me):
+    # Returns the hash of the node and its hint: the entry index + 1 if we were under a t, 0 if under l
+    cursor = expectCBORMapping(node, 0, 2)
+    cursor = expectCBORTextField(node, cursor, "e")
+    (num_entries, cursor) = extractCBORArrayLength(node, cursor)
+
+    for i in range(num_entries):
+        cursor = expectCBORMapping(node, cursor, 4)
+
+        cursor = ignoreCBORTextField1(cursor) # "k"
+        (kval, cursor) = extractCBORBytes(node, cursor)
+
+        cursor = ignoreCBORTextField1(cursor) # "p"
+        (p, cursor) = extractCBORInteger(node, cursor)
+
+        cursor = ignoreCBORTextField1(cursor) # "t"
+        (t_cid, cursor) = extractCBORNullableCID(node, cursor)
+        if t_cid == prove_me:
+            return (hashlib.sha256(node).digest(), i + 1)
+
+        cursor = ignoreCBORTextField1(cursor) # "v"
+        cursor = ignoreCBORCID(cursor)
+
+    cursor = expectCBORTextField(node, cursor, "l")
+    (found_cid, cursor) = extractCBORCID(node, cursor)
+    if found_cid != prove_me:
+        raise InvalidPayload("Value does not match target")
+    return (hashlib.sha256(node).digest(), 0)
+
+def merkleProvenRootHash(prove_me, nodes):
+    # Returns the hash of the last node, which should be the root, and the hint for each node
+    if len(nodes) == 0:
+        raise InvalidPayload("No nodes to prove the content with")
+    (prove_me, rkey, hint) = verifyDataNode(nodes[0], prove_me)
+    if rkey[0:len(APP_BSKY_FEED_POST)] != APP_BSKY_FEED_POST:
+        raise InvalidPayload("record key did not show a post")
+    hints = [hint]
+    for node in nodes[1:]:
+        (prove_me, hint) = verifyTreeNode(node, prove_me)
+        hints.append(hint)
+    return (prove_me, hints)
+
+def recoverSigner(commit_node, sig):
+    # What ecrecover() will make of the signature.
+    # ecrecover gives the zero address instead of failing, which the gateway would go on and use, so we stop here.
+    if len(sig) != 65:
+        raise InvalidPayload("Signature should be 65 bytes but is " + str(len(sig)))
+    v = sig[64]
+    if v != 27 and v != 28:
+        raise InvalidPayload("Signature did not recover a signer: v should be 27 or 28 but is " + str(v))
+    sighash = hashlib.sha256(commit_node).digest()
+    try:
+        signature = KeyAPI.Signature(vrs=(v - 27, int.from_bytes(sig[0:32], byteorder='big'), int.from_bytes(sig[32:64], byteorder='big')))
+        return KeyAPI.PublicKey.recover_from_msg_hash(sighash, signature).to_checksum_address()
+    except (BadSignature, ValidationError) as err:
+        raise InvalidPayload("Signature did not recover a signer: " + str(err))
+
+def checkBot(content, bot_name_length):
+    # Returns the bot name the message is addressed to
+    (text_start, text_end) = indexOfMessageText(content)
+    message = content[text_start:text_end]
+    if message[0:1] != b'@':
+        raise InvalidPayload("Message should begin with @")
+
+    bot_name = message[1:1 + bot_name_length].decode('utf-8', errors='replace')
+    bots = bot_registry.bots()
+    # If we don't have parser_config.json we can't tell, so leave it to the contract
+    # It may just be registered since index_events.py last ran, so this one is worth trying again
+    if len(bots) > 0 and bot_name not in bots:
+        raise Exception("Bot not found: " + bot_name)
+    if message[1 + bot_name_length:1 + bot_name_length + 1] != b' ':
+        raise InvalidPayload("No space after bot name")
+    return bot_name
+
+def hexBytes(value):
+    return bytes.fromhex(value[2:] if value.startswith('0x') else value)
+
+def validatePayload(payload):
+    # Raises an Exception saying why handleSkeet would revert, if we can tell.
+    # Otherwise returns the DID, signer and bot the gateway will see.
+    content = [hexBytes(c) for c in payload['content']]
+    nodes = [hexBytes(n) for n in payload['nodes']]
+    commit_node = hexBytes(payload['commitNode'])
+    sig = hexBytes(payload['sig'])
+    bot_name_length = int(payload['botNameLength'])
+
+    if len(content) == 0:
+        raise InvalidPayload("No content")
+    if bot_name_length < 0 or bot_name_length > 255:
+        raise InvalidPayload("botNameLength should fit in a uint8 but is " + str(bot_name_length))
+
+    (root_hash, hints) = merkleProvenRootHash(hashlib.sha256(content[0]).digest(), nodes)
+    # The contract finds its own way up the tree, but if the hints are wrong we built the proof wrong
+    if 'nodeHints' in payload and [int(h) for h in payload['nodeHints']] != hints:
+        raise InvalidPayload("nodeHints " + str(payload['nodeHints']) + " do not match the path through the nodes " + str(hints))
+
+    signer = recoverSigner(commit_node, sig)
+    did = processCommitNode(root_hash, commit_node)
+    bot_name = checkBot(content[0], bot_name_length)
+
+    return {
+        "did": did,
+        "signer": signer,
+        "botName": bot_name
+    }
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print("Usage: python payload_validator.py <payload.json> [<payload.json> ...]")
+        sys.exit(1)
+
+    is_all_valid = True
+    for payload_file in sys.argv[1:]:
+        with open(payload_file) as f:
+            payload = json.load(f)
+        try:
+            result = validatePayload(payload)
+            print("OK: " + payload_file + ": " + result['botName'] + " for " + result['did'] + " signed by " + result['signer'])
+        except Exception as err:
+            is_all_valid = False
+            print("Invalid: " + payload_file + ": " + str(err))
+
+    if not is_all_valid:
+        sys.exit(2)
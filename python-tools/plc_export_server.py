@@ -0,0 +1,61 @@
+# A local stand-in for the plc.directory /export endpoint, for trying out tail_plc_export.py.
+
+# It serves operations from a file with one JSON export entry per line, the same format plc.directory returns, eg
+#   curl 'https://plc.directory/export?count=1000' > export.jsonl
+#   python plc_export_server.py export.jsonl
+#   python tail_plc_export.py --export-url http://localhost:2583 --after 2020-01-01T00:00:00Z
+
+# You can append lines to the file while it's running to simulate new operations.
+
+import json
+import argparse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+MAX_COUNT = 1000
+
+export_file = None
+
+class ExportHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/export':
+            self.send_error(404)
+            return
+
+        params = parse_qs(url.query)
+        after = params.get('after', [''])[0]
+        count = min(int(params.get('count', [MAX_COUNT])[0]), MAX_COUNT)
+
+        lines = []
+        with open(export_file) as f:
+            for line in f:
+                if line.strip() == '':
+                    continue
+                entry = json.loads(line)
+                # createdAt is always in the same ISO format and timezone so we can compare it as a string
+                if entry['createdAt'] <= after:
+                    continue
+                lines.append(line.strip())
+                if len(lines) >= count:
+                    break
+
+        body = ("\n".join(lines) + "\n").encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/jsonlines')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("export_file", help="file with one export entry per line, in createdAt order")
+    parser.add_argument("--port", type=int, default=2583)
+    args = parser.parse_args()
+
+    export_file = args.export_file
+
+    print("Serving " + export_file + " on http://localhost:" + str(args.port) + "/export")
+    HTTPServer(('localhost', args.port), ExportHandler).serve_forever()
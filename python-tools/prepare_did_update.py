@@ -11,6 +11,7 @@
 from atproto import CAR, Client
 import urllib.request
 import sys
+import time
 import os
 import re
 import json
@@ -20,20 +21,38 @@ from multibase import encode, decode
 from eth_keys import KeyAPI
 import base64
 import argparse
+import requests
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 import did_queue
+import metrics
+import timeline
+import profiling
+import retry_queue
 
 did_queue.prepare()
 
 DID_CACHE = './dids'
 PLC_CACHE = './plcs'
+PLC_OP_CACHE = './plc_ops'
 SKEET_CACHE = './skeets'
 OUT_DIR = './out'
 
 DID_DIRECTORY = 'https://plc.directory'
 
+# How many DIDs to fetch from the directory at once when working through the queue
+PLC_FETCH_CONCURRENCY = int(os.getenv('PLC_FETCH_CONCURRENCY', 8))
+
+# How many processes to verify histories with. Verification is CPU-bound so threads wouldn't help.
+DID_VERIFY_WORKERS = int(os.getenv('DID_VERIFY_WORKERS', os.cpu_count() or 1))
+
+# How many queued DIDs to read in one go
+DID_PAYLOAD_BATCH_SIZE = int(os.getenv('DID_PAYLOAD_BATCH_SIZE', 200))
+
 # https://plc.directory/did:plc:pyzlzqt6b2nyrha7smfry6rv/log/audit
 
+# Results of verifyOperation by operation CID
+verified_ops = {}
 
 def pubkeyCompressedAndUncompressed(pubkey):
     # return the uncompressed pubkey
@@ -84,37 +103,228 @@ def recoverPubkeyAndVParam(sighash, r, s, addresses):
 
     raise Exception("Could not find a v value matching the signature for a key in the did record")
 
-def loadHistory(did):
+def prepareCacheDirs():
+    for d in [OUT_DIR, PLC_CACHE, DID_CACHE]:
+        if not os.path.exists(d):
+            os.mkdir(d)
 
-    if not os.path.exists(OUT_DIR):
-        os.mkdir(OUT_DIR)
+def didFile(did):
+    return DID_CACHE + '/' + hashlib.sha256(did.encode()).hexdigest()
 
-    if not os.path.exists(PLC_CACHE):
-        os.mkdir(PLC_CACHE)
+def plcFile(did):
+    # NB You have to get the right endpoint here, BSky service won't tell you about other people's PDSes.
+    return PLC_CACHE + '/' + hashlib.sha256(did.encode()).hexdigest() + '.plc'
+
+def loadHistory(did):
 
-    if not os.path.exists(DID_CACHE):
-        os.mkdir(DID_CACHE)
+    prepareCacheDirs()
 
-    did_file = DID_CACHE + '/' + hashlib.sha256(did.encode()).hexdigest()
+    did_file = didFile(did)
     addresses = []
     if not os.path.exists(did_file):
         did_url = DID_DIRECTORY + '/' + did
-        urllib.request.urlretrieve(did_url, did_file)
+        with metrics.timer('plc_request_seconds', {"call": "did"}):
+            urllib.request.urlretrieve(did_url, did_file)
 
     #with open(did_file, mode="r") as didf:
     #    data = json.load(didf)
     #    for vm in data['verificationMethod']: 
     #        addresses.append(vm['publicKeyMultibase'])
 
-    # NB You have to get the right endpoint here, BSky service won't tell you about other people's PDSes.
-    plc_file = PLC_CACHE + '/' + hashlib.sha256(did.encode()).hexdigest() + '.plc'
+    plc_file = plcFile(did)
     if not os.path.exists(plc_file):
         plc_url = DID_DIRECTORY + '/' + did + '/log/audit'
-        urllib.request.urlretrieve(plc_url, plc_file)
+        with metrics.timer('plc_request_seconds', {"call": "audit"}):
+            urllib.request.urlretrieve(plc_url, plc_file)
 
     with open(plc_file, mode="rb") as cf:
         return json.load(cf)
 
+def fetchToCache(session, url, cache_file, call):
+    # Returns how long the request took, or None if it was already cached
+    is_cached = os.path.exists(cache_file)
+    metrics.cacheResult(call, is_cached)
+    if is_cached:
+        return None
+    start = time.monotonic()
+    with metrics.timer('plc_request_seconds', {"call": call}):
+        response = session.get(url, timeout=60)
+    seconds = time.monotonic() - start
+    response.raise_for_status()
+    # Write it under a temporary name so another run never sees half a file
+    tmp_file = cache_file + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(response.content)
+    os.replace(tmp_file, cache_file)
+    return seconds
+
+def fetchHistory(session, did):
+    # Same files as loadHistory, so once this has run loadHistory doesn't need the network.
+    # Returns the requests we made and how long they took.
+    calls = []
+    for call, url, cache_file in [
+        ('did', DID_DIRECTORY + '/' + did, didFile(did)),
+        ('audit', DID_DIRECTORY + '/' + did + '/log/audit', plcFile(did))
+    ]:
+        seconds = fetchToCache(session, url, cache_file, call)
+        if seconds is not None:
+            calls.append(('plc_request:' + call, seconds))
+    return calls
+
+def fetchHistories(dids):
+    # Returns a dict of did -> the requests we made for it, and a dict of did -> exception for any we couldn't fetch
+    prepareCacheDirs()
+    calls = {}
+    errors = {}
+    with requests.Session() as session:
+        # Keep a connection open for each worker instead of reconnecting for every request
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=PLC_FETCH_CONCURRENCY)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        with ThreadPoolExecutor(max_workers=PLC_FETCH_CONCURRENCY) as executor:
+            futures = {executor.submit(fetchHistory, session, did): did for did in dids}
+            for future in as_completed(futures):
+                try:
+                    calls[futures[future]] = future.result()
+                except Exception as e:
+                    errors[futures[future]] = e
+    return calls, errors
+
+def verifiedOpFile(cid):
+    return PLC_OP_CACHE + '/' + hashlib.sha256(cid.encode()).hexdigest() + '.json'
+
+def loadVerifiedOp(cid):
+    if cid in verified_ops:
+        return verified_ops[cid]
+    op_file = verifiedOpFile(cid)
+    if not os.path.exists(op_file):
+        return None
+    try:
+        with open(op_file) as f:
+            verified = json.load(f)
+    except ValueError:
+        # Not a complete file, so check the operation again and overwrite it
+        return None
+    verified_ops[cid] = verified
+    return verified
+
+def saveVerifiedOp(cid, verified):
+    verified_ops[cid] = verified
+    if not os.path.exists(PLC_OP_CACHE):
+        os.mkdir(PLC_OP_CACHE)
+    # Worker processes may write the same one at once, so each uses its own temporary name
+    op_file = verifiedOpFile(cid)
+    tmp_file = op_file + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(verified, f)
+    os.replace(tmp_file, op_file)
+
+def verifyOperation(entry, signing_keys):
+    # Does the expensive work for a single operation: encoding, finding the sig, and recovering the key that signed it.
+    # signing_keys is the rotation keys from the previous operation, or None for the genesis operation, which signs with its own.
+    # An operation never changes once it has a CID, so we keep the result and only redo it if the keys it was checked against differ.
+    signing_keys_hex = None
+    if signing_keys is not None:
+        signing_keys_hex = [k.hex() for k in signing_keys]
+
+    cached = loadVerifiedOp(entry['cid'])
+    is_cache_hit = cached is not None and cached['signingKeys'] == signing_keys_hex
+    metrics.cacheResult('verified_op', is_cache_hit)
+    if is_cache_hit:
+        return cached
+
+    op = entry["operation"]
+    cbor_bytes = libipld.encode_dag_cbor(op)
+    sig_in_base64_url = op["sig"]
+
+    # apparently the base64 lib gets mad about too little padding at the end, but doesn't care if you give it too much
+    sig = base64.urlsafe_b64decode(op["sig"] + '===') 
+    r = sig[0:32]
+    s = sig[32:64]
+
+    # print(op)
+    entry_verification_key = None
+    if 'verificationMethods' in op and 'atproto' in op['verificationMethods']:
+        ver_key = op["verificationMethods"]["atproto"]
+        ver_key_base58btc = ver_key.lstrip("did:key:")
+        entry_verification_key = decode(ver_key_base58btc)[2:].hex()
+
+    next_rotation_keys = []
+    for did_key in op["rotationKeys"]:
+        did_key_base58btc = did_key.lstrip("did:key:")
+        did_key_decoded = decode(did_key_base58btc)[2:]
+        next_rotation_keys.append(did_key_decoded)
+
+    # For the genesis operation, we sign with our own rotation keys ¯\_(ツ)_/¯
+    active_rotation_keys = signing_keys
+    if active_rotation_keys is None:
+        active_rotation_keys = next_rotation_keys
+
+    signed_op = op.copy()
+    del signed_op["sig"]
+    signable_cbor = libipld.encode_dag_cbor(signed_op)
+
+    # Find the index where the sig starts for when we need to reconstruct the signed 
+
+    # There will be 2 differences to the cbor-encoded version with the signature stripped.
+    # Firstly it will be a mapping with 1 entry fewer, so the first byte will differ by 1.
+    # Secondly the "sig: encoded text" will be different, which will be:
+    #  - Text header + sig
+    #  - Text header for however much text + the text
+    # This will be a 
+    mapping_byte_signed = int.from_bytes(cbor_bytes[0:1], byteorder='big')
+    mapping_byte_signable = int.from_bytes(signable_cbor[0:1], byteorder='big')
+    if mapping_byte_signed != mapping_byte_signable + 1:
+        raise Exception("Unexpected initial cbor mapping entry count")
+
+    # Get the index where the sig field will be added
+    # This will always be 1 unless they add a key that sorts before "sig" (ie 3 letters or less)
+    sig_bytes = b''.join([libipld.encode_dag_cbor("sig"), libipld.encode_dag_cbor(sig_in_base64_url)])
+    sig_start_idx = cbor_bytes.find(sig_bytes)
+
+    # Sanity-check this by putting the original cbor back together
+    recreated_cbor = b''.join([cbor_bytes[0:1], signable_cbor[1:sig_start_idx], sig_bytes, signable_cbor[sig_start_idx:]])
+    if recreated_cbor != cbor_bytes:
+        raise Exception("Something went wrong with our assumptions about encoding the sig in cbor")
+
+    sig_hash = hashlib.sha256(signable_cbor).digest()
+    #print("made sig_hash")
+    #print(sig_hash.hex())
+
+    pubkey_str, v, rotation_key_idx = recoverPubkeyAndVParam(sig_hash, r, s, active_rotation_keys)
+    full_sig = b''.join([r, s, v.to_bytes(1, byteorder="big")])
+    #print("rs")
+    #print(r.hex());
+    #print(s.hex());
+
+    prev_hash = None
+    if op["prev"] is not None:
+        prev_hash = decode(op["prev"])[4:].hex()
+
+    op_hash = hashlib.sha256(cbor_bytes).digest()
+
+    verified = {
+        "signingKeys": signing_keys_hex,
+        "signableCbor": "0x"+signable_cbor.hex(),
+        "sigStartIdx": sig_start_idx,
+        "sigHash": "0x"+sig_hash.hex(),
+        "sig": "0x"+full_sig.hex(),
+        "decodedSig": "0x"+sig.hex(),
+        "pubkey": pubkey_str,
+        "v": v,
+        "rotationKeyIdx": rotation_key_idx,
+        "rotationKeys": [k.hex() for k in next_rotation_keys],
+        "verificationKey": entry_verification_key,
+        "opHash": op_hash.hex(),
+        "prevHash": prev_hash
+    }
+
+    # Only keep it if the CID really is the hash of this operation, so nothing else can claim its cache entry
+    if decode(entry['cid'])[4:] == op_hash:
+        saveVerifiedOp(entry['cid'], verified)
+
+    return verified
+
 def generatePayload(did, did_history):
 
     # Output sorts keys alphabetically for compatibility with Forge json parsing.
@@ -134,8 +344,7 @@ def generatePayload(did, did_history):
         "rotationKeys": []
     }
 
-    active_rotation_keys = []
-    next_rotation_keys = []
+    active_rotation_keys = None
 
     is_first = True
     last_signed_op_hash = None
@@ -146,140 +355,142 @@ def generatePayload(did, did_history):
         #print(entry)
         # {"did":"did:plc:pyzlzqt6b2nyrha7smfry6rv","operation":{"sig":"qI31xjIX949GGbwWqsSGU5FZLVrfbv9N_695lr61w_MYgfsJE_k-oG8SQVLjWk20esEdhA55pFUCeQEJ7hZGDw","prev":"bafyreibufnyztvxkqnth2fjj4sggvhncw4rbhrdxjttejvboc3s6j72yyy","type":"plc_operation","services":{"atproto_pds":{"type":"AtprotoPersonalDataServer","endpoint":"https://lionsmane.us-east.host.bsky.network"}},"alsoKnownAs":["at://goat.navy"],"rotationKeys":["did:key:zQ3shhCGUqDKjStzuDxPkTxN6ujddP4RkEKJJouJGRRkaLGbg","did:key:zQ3shpKnbdPx3g3CmPf5cRVTPe1HtSwVn5ish3wSnDPQCbLJK"],"verificationMethods":{"atproto":"did:key:zQ3shRQWmWxEtxRa317rpYnVo7nWxYAsDS4mBwdDLgLfkkDtR"}},"cid":"bafyreifbilrkm7ktlamiqslrjq33bbnhs6pj4pstasnpg4ly5mimmjxjam","nullified":false,"createdAt":"2024-09-08T09:30:26.927Z"}]
         op = entry["operation"]
-        cbor_bytes = libipld.encode_dag_cbor(op)
-        sig_in_base64_url = op["sig"]
 
-        # apparently the base64 lib gets mad about too little padding at the end, but doesn't care if you give it too much
-        sig = base64.urlsafe_b64decode(op["sig"] + '===') 
-        r = sig[0:32]
-        s = sig[32:64]
+        verified = verifyOperation(entry, active_rotation_keys)
+
         test_vectors["base64URLSig"].append({
             "encoded": op["sig"],
-            "decoded": "0x"+sig.hex()
+            "decoded": verified["decodedSig"]
         })
-        
-        # print(op)
-        # only really needed for the last item
-        entry_verification_key = None
-        if 'verificationMethods' in op and 'atproto' in op['verificationMethods']:
-            ver_key = op["verificationMethods"]["atproto"]
-            ver_key_base58btc = ver_key.lstrip("did:key:")
-            entry_verification_key = decode(ver_key_base58btc)[2:]
-
-        next_rotation_keys = []
-        for did_key in op["rotationKeys"]:
-            did_key_base58btc = did_key.lstrip("did:key:")
-            did_key_decoded = decode(did_key_base58btc)[2:]
-            next_rotation_keys.append(did_key_decoded)
+        for i in range(len(op["rotationKeys"])):
             test_vectors['rotationKeys'].append({
-                "encoded": did_key,
-                "decoded": "0x"+did_key_decoded.hex()
+                "encoded": op["rotationKeys"][i],
+                "decoded": "0x"+verified["rotationKeys"][i]
             })
-                
-
-        # For the genesis operation, we sign with our own rotation keys ¯\_(ツ)_/¯
-        if is_first:
-            active_rotation_keys = next_rotation_keys
-
-        signed_op = op.copy()
-        del signed_op["sig"]
-        signable_cbor = libipld.encode_dag_cbor(signed_op)
-
-        # Find the index where the sig starts for when we need to reconstruct the signed 
-
-        # There will be 2 differences to the cbor-encoded version with the signature stripped.
-        # Firstly it will be a mapping with 1 entry fewer, so the first byte will differ by 1.
-        # Secondly the "sig: encoded text" will be different, which will be:
-        #  - Text header + sig
-        #  - Text header for however much text + the text
-        # This will be a 
-        mapping_byte_signed = int.from_bytes(cbor_bytes[0:1], byteorder='big')
-        mapping_byte_signable = int.from_bytes(signable_cbor[0:1], byteorder='big')
-        if mapping_byte_signed != mapping_byte_signable + 1:
-            raise Exception("Unexpected initial cbor mapping entry count")
-
-        # Get the index where the sig field will be added
-        # This will always be 1 unless they add a key that sorts before "sig" (ie 3 letters or less)
-        sig_bytes = b''.join([libipld.encode_dag_cbor("sig"), libipld.encode_dag_cbor(sig_in_base64_url)])
-        sig_start_idx = cbor_bytes.find(sig_bytes)
-
-        # Sanity-check this by putting the original cbor back together
-        recreated_cbor = b''.join([cbor_bytes[0:1], signable_cbor[1:sig_start_idx], sig_bytes, signable_cbor[sig_start_idx:]])
-        if recreated_cbor != cbor_bytes:
-            raise Exception("Something went wrong with our assumptions about encoding the sig in cbor")
-
-        sig_hash = hashlib.sha256(signable_cbor).digest()
-        #print("made sig_hash")
-        #print(sig_hash.hex())
-
-        pubkey_str, v, rotation_key_idx = recoverPubkeyAndVParam(sig_hash, r, s, active_rotation_keys)
-        sig = b''.join([r, s, v.to_bytes(1, byteorder="big")])
-        #print("rs")
-        #print(r.hex());
-        #print(s.hex());
 
         # TODO: In solidity, see if it's easier to pass the sig then base64-url-encode it to recreate the signed cbor
         # ...or pass the full signed cbor and base64-url-decode it to make the signature
 
-        output["ops"].append("0x"+signable_cbor.hex())
-        output["pubkeyIndexes"].append(rotation_key_idx)
-        output["pubkeys"].append(pubkey_str)
-        output["sigs"].append("0x"+sig.hex())
+        output["ops"].append(verified["signableCbor"])
+        output["pubkeyIndexes"].append(verified["rotationKeyIdx"])
+        output["pubkeys"].append(verified["pubkey"])
+        output["sigs"].append(verified["sig"])
             
         #print(cbor)
         #print(cid_hash)
 
         if is_first:
-            if op["prev"] is not None:
+            if verified["prevHash"] is not None:
                 #print(op["prev"])
                 raise Exception("Genesis operation had a prev set which is weird")
         else:
-            if last_signed_op_hash != decode(op["prev"])[4:]:
+            if last_signed_op_hash != verified["prevHash"]:
                 raise Exception("prev does not match hash of previous entry")
             test_vectors["cid"].append({
                 "encoded": op["prev"],
-                "decoded": "0x"+last_signed_op_hash.hex()    
+                "decoded": "0x"+last_signed_op_hash
             })
 
 
-        last_signed_op_hash = hashlib.sha256(cbor_bytes).digest()
+        last_signed_op_hash = verified["opHash"]
+        # only really needed for the last item
+        entry_verification_key = verified["verificationKey"]
 
         is_first = False
-        active_rotation_keys = next_rotation_keys
+        active_rotation_keys = [bytes.fromhex(k) for k in verified["rotationKeys"]]
 
 
     # Shift the pubkeys and indexes up 1 as we sign with the pubkey from the previous entry
     output['pubkeys'] = output['pubkeys'][1:]
     output['pubkeyIndexes'] = output['pubkeyIndexes'][1:]
 
-    validator_pubkey = KeyAPI.PublicKey.from_compressed_bytes(entry_verification_key)
+    validator_pubkey = KeyAPI.PublicKey.from_compressed_bytes(bytes.fromhex(entry_verification_key))
     output['pubkeys'].append(str(validator_pubkey))
     # print("address:")
     # print(validator_pubkey.to_checksum_address())
 
     return output, test_vectors
 
-def processQueuedPayloads():
-    while True:
-        item = did_queue.readNext("payload")
-        if item is None:
-            break
-
-        did = item['did']
-
-        # TODO: Check this picks up from the right place
-        did_history = loadHistory(did)
-
-        print(did)
-        print(did_history)
-        item, test_vectors = generatePayload(did, did_history)
-        print(item)
+def verifyQueuedDid(item):
+    # Runs in a worker process, after fetchHistories has cached the history
+    did = item['did']
+    try:
+        with metrics.timer('stage_seconds', {"stage": "did_payload"}), timeline.running(item, "payload"):
+            did_history = loadHistory(did)
+            new_item, test_vectors = generatePayload(did, did_history)
+        return timeline.carry(item, new_item)
+    finally:
+        # Worker processes exit without running atexit handlers
+        metrics.flush()
+
+def verifyAll(executor, items):
+    # Yields (queued item, new item, exception) as each finishes
+    if executor is None:
+        for item in items:
+            try:
+                yield item, verifyQueuedDid(item), None
+            except Exception as e:
+                yield item, None, e
+        return
+    futures = {executor.submit(verifyQueuedDid, item): item for item in items}
+    for future in as_completed(futures):
+        try:
+            yield futures[future], future.result(), None
+        except Exception as e:
+            yield futures[future], None, e
 
-        # item['payload'] = generatePayload(car, param_did, param_rkey, addresses)
-        did_queue.updateStatus(did, "payload", "tx", item)
+def processQueuedPayloads():
+    executor = None
+    if profiling.isEnabled():
+        # Verify in this process so the work shows up in the profile
+        print("Profiling, so verifying without worker processes")
+    else:
+        # Each worker only flushes the metrics it recorded itself, not the ones it was forked with
+        executor = ProcessPoolExecutor(max_workers=DID_VERIFY_WORKERS, initializer=metrics.discardPending)
+
+    try:
+        while True:
+            items = did_queue.readItems("payload", DID_PAYLOAD_BATCH_SIZE)
+            if len(items) == 0:
+                break
+
+            for item in items:
+                timeline.started(item, "payload")
+
+            # TODO: Check this picks up from the right place
+            fetch_calls, fetch_errors = fetchHistories([item['did'] for item in items])
+
+            to_verify = []
+            for item in items:
+                did = item['did']
+                for call, seconds in fetch_calls.get(did, []):
+                    timeline.addCall(item, "payload", call, seconds)
+                if did in fetch_errors:
+                    print("Could not fetch history for " + did + ": " + str(fetch_errors[did]))
+                    retry_queue.recordFailure(item, "payload", fetch_errors[did])
+                    did_queue.updateStatus(did, "payload", "payload_retry", item)
+                    continue
+                to_verify.append(item)
+
+            # Only this process touches the queue, so moves happen one at a time whatever order the workers finish in
+            for item, new_item, err in verifyAll(executor, to_verify):
+                did = item['did']
+                if err is not None:
+                    print("Could not prepare update for " + did + ": " + str(err))
+                    retry_queue.recordFailure(item, "payload", err)
+                    did_queue.updateStatus(did, "payload", "payload_retry", item)
+                    continue
+                print(did)
+                print(new_item)
+                did_queue.updateStatus(did, "payload", "tx", new_item)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
 if __name__ == '__main__':
 
+    profiling.startIfRequested()
+
     if len(sys.argv) == 1 or (len(sys.argv) == 2 and sys.argv[1] == "queue"):
         processQueuedPayloads()
         sys.exit(0)
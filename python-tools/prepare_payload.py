@@ -12,15 +12,25 @@ from atproto import CAR, Client
 import urllib.request
 import sys
 import os
+import time
+import threading
 import re
 import json
+import copy
 import hashlib
+import itertools
 import libipld
 from multibase import encode, decode
 from eth_keys import KeyAPI
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import skeet_queue
-import skeet_gateway
+import skeet_classifier
+import bot_registry
+import metrics
+import timeline
+import profiling
+import retry_queue
 
 skeet_queue.prepare()
 
@@ -30,22 +40,25 @@ SKEET_CACHE = './skeets'
 OUT_DIR = './out'
 
 DID_DIRECTORY = 'https://plc.directory'
-PARSER_CONFIG = 'parser_config.json'
+
+# How many posts and DID documents to fetch at once when working through the queue
+CAR_FETCH_CONCURRENCY = int(os.getenv('CAR_FETCH_CONCURRENCY', 8))
+
+# How many queued items to read at a time, so items for the same post can share a CAR
+PAYLOAD_BATCH_SIZE = int(os.getenv('PAYLOAD_BATCH_SIZE', 100))
+
+# Payloads we already made this run by (did, rkey, commit CID), or the exception we got trying.
+# A post is queued once for each bot it was fetched for, but the proof doesn't depend on the bot.
+# readFair takes turns between bots, so in a flood a post's items for different bots can be many batches apart.
+# Instead of clearing it between batches we keep the PROOF_CACHE_SIZE most recently used, oldest first.
+PROOF_CACHE_SIZE = int(os.getenv('PROOF_CACHE_SIZE', 1000))
+proofs = {}
 
 # Returns whether or not the bot needs us to send it content of the skeet they're replying to.
-# Hard-coding this for now. 
+# This comes from the bot metadata in parser_config.json.
 # Later we will probably add this information to the SkeetGateway contract.
-# (It shouldn't change so it should be cacheable after you meet each bot for the first time.)
 def isReplyParentContentNeededByBot(botName):
-    try:
-        with open(PARSER_CONFIG, mode="r") as cf:
-            data = json.load(cf)
-            bot_entry = data[botName]
-            if 'metadata' in bot_entry and 'reply' in bot_entry['metadata']:
-                return bool(bot_entry['metadata']['reply'])
-        return False
-    except:
-        return False
+    return bool(bot_registry.metadata(botName).get('reply', False))
 
 def fetchAtURIForSkeetURL(skeet_url):
 
@@ -70,16 +83,86 @@ def fetchAtURIForSkeetURL(skeet_url):
     print("Fetched at:// URI " + at_addr)
     return at_addr
 
+def prepareCacheDirs():
+    for cache_dir in [OUT_DIR, CAR_CACHE, DID_CACHE]:
+        os.makedirs(cache_dir, exist_ok=True)
+
+def didFile(did):
+    return DID_CACHE + '/' + hashlib.sha256(did.encode()).hexdigest()
+
+def carFile(did, rkey):
+    raw_filename = did + '-' + rkey
+    return CAR_CACHE + '/' + hashlib.sha256(raw_filename.encode()).hexdigest() + '.car'
+
+def retrieveToCache(url, cache_file, cache, metric, call):
+    # Returns how long the request took, or None if it was already cached
+    is_cached = os.path.exists(cache_file)
+    metrics.cacheResult(cache, is_cached)
+    if is_cached:
+        return None
+    # Another thread may be fetching the same file, so each writes its own then moves it into place
+    tmp_file = cache_file + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+    start = time.monotonic()
+    with metrics.timer(metric, {"call": call}):
+        urllib.request.urlretrieve(url, tmp_file)
+    os.replace(tmp_file, cache_file)
+    return time.monotonic() - start
+
+def fetchDid(did):
+    # Returns the requests we made, as (call, seconds)
+    prepareCacheDirs()
+    seconds = retrieveToCache(DID_DIRECTORY + '/' + did, didFile(did), 'did', 'plc_request_seconds', 'did')
+    if seconds is None:
+        return []
+    return [('plc_request:did', seconds)]
+
+def fetchCar(did, rkey):
+    # Makes sure the DID document and the CAR for the post are in the cache.
+    # Returns the requests we made, as (call, seconds).
+    calls = fetchDid(did)
+    with open(didFile(did), mode="r") as didf:
+        endpoint = json.load(didf)['service'][0]['serviceEndpoint']
+    # NB You have to get the right endpoint here, BSky service won't tell you about other people's PDSes.
+    car_url = endpoint + '/xrpc/com.atproto.sync.getRecord?did='+did+'&collection=app.bsky.feed.post&rkey='+rkey
+    seconds = retrieveToCache(car_url, carFile(did, rkey), 'car', 'pds_request_seconds', 'getRecord')
+    if seconds is not None:
+        calls.append(('pds_request:getRecord', seconds))
+    return calls
+
+def fetchPost(at_uri):
+    (did, rkey) = atURIToDidAndRkey(at_uri)
+    return fetchCar(did, rkey)
+
+def prefetchCars(items):
+    # Fetch the posts for the items, and the posts they reply to for bots that need them, all at the same time,
+    # so building the proofs doesn't have to wait for the network.
+    wanted = {}
+    for item in items:
+        wanted.setdefault(item['atURI'], []).append(item)
+        parent_uri = item.get('x_reply_parent_uri')
+        if parent_uri is not None and isReplyParentContentNeededByBot(item['botName']):
+            wanted.setdefault(parent_uri, []).append(item)
+    with ThreadPoolExecutor(max_workers=CAR_FETCH_CONCURRENCY) as executor:
+        futures = {executor.submit(fetchPost, at_uri): at_uri for at_uri in wanted}
+        for future in as_completed(futures):
+            at_uri = futures[future]
+            try:
+                calls = future.result()
+            except Exception as err:
+                # loadCar will try again when we get to the item, and fail it in the usual way
+                print("Could not prefetch " + at_uri + ": " + str(err))
+                continue
+            for item in wanted[at_uri]:
+                for call, seconds in calls:
+                    timeline.addCall(item, "payload", call, seconds)
+
 def didInfo(did):
 
-    did_file = DID_CACHE + '/' + hashlib.sha256(did.encode()).hexdigest()
     address = None
     handles = []
-    if not os.path.exists(did_file):
-        did_url = DID_DIRECTORY + '/' + did
-        urllib.request.urlretrieve(did_url, did_file)
+    fetchDid(did)
 
-    with open(did_file, mode="r") as didf:
+    with open(didFile(did), mode="r") as didf:
         data = json.load(didf)
         for vm in data['verificationMethod']: 
             signer_key = vm['publicKeyMultibase']
@@ -92,38 +175,24 @@ def didInfo(did):
 
     return handles, address
 
-def loadCar(did, rkey):
-
-    if not os.path.exists(OUT_DIR):
-        os.mkdir(OUT_DIR)
+def resolveDids(dids):
+    # didInfo() for each DID, in the order given, fetching any we don't have cached at the same time
+    unique_dids = list(dict.fromkeys(dids))
+    with ThreadPoolExecutor(max_workers=CAR_FETCH_CONCURRENCY) as executor:
+        list(executor.map(fetchDid, unique_dids))
+    return {did: didInfo(did) for did in unique_dids}
 
-    if not os.path.exists(CAR_CACHE):
-        os.mkdir(CAR_CACHE)
+def loadCar(did, rkey):
 
-    if not os.path.exists(DID_CACHE):
-        os.mkdir(DID_CACHE)
+    fetchCar(did, rkey)
 
-    did_file = DID_CACHE + '/' + hashlib.sha256(did.encode()).hexdigest()
     addresses = []
-    if not os.path.exists(did_file):
-        did_url = DID_DIRECTORY + '/' + did
-        urllib.request.urlretrieve(did_url, did_file)
-
-    endpoint = None
-    with open(did_file, mode="r") as didf:
+    with open(didFile(did), mode="r") as didf:
         data = json.load(didf)
-        endpoint = data['service'][0]['serviceEndpoint']
         for vm in data['verificationMethod']: 
             addresses.append(vm['publicKeyMultibase'])
 
-    # NB You have to get the right endpoint here, BSky service won't tell you about other people's PDSes.
-    raw_filename = did + '-' + rkey
-    car_file = CAR_CACHE + '/' + hashlib.sha256(raw_filename.encode()).hexdigest() + '.car'
-    if not os.path.exists(car_file):
-        car_url = endpoint + '/xrpc/com.atproto.sync.getRecord?did='+did+'&collection=app.bsky.feed.post&rkey='+rkey
-        urllib.request.urlretrieve(car_url, car_file)
-
-    with open(car_file, mode="rb") as cf:
+    with open(carFile(did, rkey), mode="rb") as cf:
         contents = cf.read()
         car_file = CAR.from_bytes(contents)
         return (car_file, addresses)
@@ -288,6 +357,26 @@ def generatePayload(car_file, did, rkey, addresses, at_uri):
 
     return output
 
+def provePost(car_file, did, rkey, addresses, at_uri):
+    # generatePayload() for a post, only doing the work the first time we see its commit
+    key = (did, rkey, str(car_file.root))
+    metrics.cacheResult('proof', key in proofs)
+    if key in proofs:
+        # Move it to the end so it's the last to go
+        proofs[key] = proofs.pop(key)
+    else:
+        try:
+            proofs[key] = (generatePayload(car_file, did, rkey, addresses, at_uri), None)
+        except Exception as err:
+            proofs[key] = (None, err)
+        if len(proofs) > PROOF_CACHE_SIZE:
+            del proofs[next(iter(proofs))]
+    payload, err = proofs[key]
+    if err is not None:
+        raise err
+    # Each item gets its own copy since they add their own timeline and history to it
+    return copy.deepcopy(payload)
+
 def atURIToDidAndRkey(at_uri):
     m = re.match(r'^at:\/\/(did:plc:.*?)/app\.bsky\.feed\.post\/(.*)$', at_uri)
     did = m.group(1)
@@ -302,7 +391,7 @@ def generateReply(at_uri, bot, item, car):
 
     msg = ''
 
-    if bot == 'pay.skeetbot.eth.link':
+    if bot == skeet_classifier.PAY_BOT:
         for cid in car.blocks:
             b = car.blocks[cid]
             if 'text' not in b:
@@ -327,20 +416,24 @@ def generateReply(at_uri, bot, item, car):
 
                 i = i + 1
 
-            targets = {}
-
+            mention_dids = []
             if 'facets' in b:
                 for facet in b['facets']:
                     for feature in facet['features']:
                         if not '$type' in feature or feature['$type'] != 'app.bsky.richtext.facet#mention':
                             continue
-                        handles, address = didInfo(feature['did'])
-                        if 'at://'+bot in handles:
-                            continue
-                            # print("skipping entry for bot")
-                        else:
-                            targets[feature['did']] = address
-                            #print("found target did" + str(feature['did']))
+                        mention_dids.append(feature['did'])
+
+            targets = {}
+            did_infos = resolveDids(mention_dids)
+            for did in did_infos:
+                handles, address = did_infos[did]
+                if 'at://'+bot in handles:
+                    continue
+                    # print("skipping entry for bot")
+                else:
+                    targets[did] = address
+                    #print("found target did" + str(did))
 
             if amount == '':
                 amount = '<amount>'
@@ -348,9 +441,12 @@ def generateReply(at_uri, bot, item, car):
             if token == '':
                 token = 'ETH'
 
-            for did in targets:
-                signer = targets[did]
-                addr = skeet_gateway.selectedSafeAddress(did, signer)
+            # Only pay replies need the chain, so don't load web3 until we get one
+            import skeet_gateway
+
+            # Look up all their safes in one call
+            safe_addrs = skeet_gateway.selectedSafeAddresses([(did, targets[did]) for did in targets])
+            for addr in safe_addrs:
                 msg = msg + '@' + bot + ' ' + addr+ ' ' + amount + ' ' + token
                 msg = msg + "\n"
 
@@ -370,74 +466,80 @@ def needsTransaction(at_uri, bot, item, car):
     # Convert DIDs in mentions to wallet addresses
     print(bot)
 
-    if bot == 'pay.skeetbot.eth.link':
+    if bot == skeet_classifier.PAY_BOT:
         for cid in car.blocks:
             b = car.blocks[cid] 
             if 'text' not in b:
                 continue
 
-            text = b['text']
-
-            if not text.startswith('@'):
-                return False
-
-            message_bits = b['text'].split()
-            if len(message_bits) < 3:
-                return False
-
-            bot_name = message_bits[0]
-            # print("bot is " + bot_name)
-            if bot_name[0:1] != '@':
-                return False
-
-            # bits 1 should be a decimal
-            poss_num = message_bits[1]
-            if len(poss_num) > 18:
-                return False
-
-            pattern1 = re.compile(r'^\d+$')
-            pattern2 = re.compile(r'^\d+\.\d+$')
-            if not pattern1.match(poss_num) and not pattern2.match(poss_num):
-                return False
-
-            if message_bits[2] != 'ETH':
+            if not skeet_classifier.isPayCommand(b['text']):
                 return False
 
     return True
 
 def processQueuedPayloads():
+    # Take turns between bots so one busy bot doesn't hold up the others
+    queued = skeet_queue.readFair("payload")
     while True:
-        item = skeet_queue.readNext("payload")
-        if item is None:
+        items = list(itertools.islice(queued, PAYLOAD_BATCH_SIZE))
+        if len(items) == 0:
             break
+        prefetchCars(items)
+        # Load each post once for all the bots it's queued for
+        by_uri = {}
+        for item in items:
+            by_uri.setdefault(item['atURI'], []).append(item)
+        for at_uri in by_uri:
+            car = None
+            load_err = None
+            for item in by_uri[at_uri]:
+                with metrics.timer('stage_seconds', {"stage": "payload"}), timeline.running(item, "payload"):
+                    if car is None and load_err is None:
+                        try:
+                            (param_did, param_rkey) = atURIToDidAndRkey(at_uri)
+                            car = loadCar(param_did, param_rkey)
+                        except Exception as err:
+                            load_err = err
+                    if load_err is not None:
+                        # Every bot's item for the post goes to retry, rather than stopping the whole run
+                        retry_queue.recordFailure(item, "payload", load_err)
+                        skeet_queue.updateStatus(at_uri, item['botName'], "payload", "payload_retry", item)
+                        continue
+                    handleQueuedPayload(item, car)
+
+def handleQueuedPayload(item, loaded_car=None):
+    print(item)
+    at_uri = item['atURI']
+    bot = item['botName']
 
-        print(item)
-        at_uri = item['atURI']
-        bot = item['botName']
-
-        (param_did, param_rkey) = atURIToDidAndRkey(at_uri)
-        (car, addresses) = loadCar(param_did, param_rkey)
-
-        item['did'] = param_did 
-        item['rkey'] = param_rkey 
-
-        if needsTransaction(at_uri, bot, item, car):
-            try:
-                item = generatePayload(car, param_did, param_rkey, addresses, at_uri)
-                # item['payload'] = generatePayload(car, param_did, param_rkey, addresses)
-                skeet_queue.updateStatus(at_uri, bot, "payload", "tx", item)
-            except:
-                skeet_queue.updateStatus(at_uri, bot, "payload", "payload_retry", item)
+    (param_did, param_rkey) = atURIToDidAndRkey(at_uri)
+    if loaded_car is None:
+        loaded_car = loadCar(param_did, param_rkey)
+    (car, addresses) = loaded_car
+
+    item['did'] = param_did 
+    item['rkey'] = param_rkey 
+
+    if needsTransaction(at_uri, bot, item, car):
+        try:
+            item = timeline.carry(item, provePost(car, param_did, param_rkey, addresses, at_uri))
+            # item['payload'] = generatePayload(car, param_did, param_rkey, addresses)
+            skeet_queue.updateStatus(at_uri, bot, "payload", "tx", item)
+        except Exception as err:
+            retry_queue.recordFailure(item, "payload", err)
+            skeet_queue.updateStatus(at_uri, bot, "payload", "payload_retry", item)
+    else:
+        item, has_reply = generateReply(at_uri, bot, item, car)
+        if has_reply:
+            # TODO: Should this be its own queue, it doesn't need to query the chain
+            skeet_queue.updateStatus(at_uri, bot, "payload", "report", item)
         else:
-            item, has_reply = generateReply(at_uri, bot, item, car)
-            if has_reply:
-                # TODO: Should this be its own queue, it doesn't need to query the chain
-                skeet_queue.updateStatus(at_uri, bot, "payload", "report", item)
-            else:
-                skeet_queue.updateStatus(at_uri, bot, "payload", "ignored", item)
+            skeet_queue.updateStatus(at_uri, bot, "payload", "ignored", item)
 
 if __name__ == '__main__':
 
+    profiling.startIfRequested()
+
     if len(sys.argv) == 1 or (len(sys.argv) == 2 and sys.argv[1] == "queue"):
         processQueuedPayloads()
         sys.exit(0)
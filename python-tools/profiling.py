@@ -0,0 +1,44 @@
+# Opt-in profiling for the queue scripts.
+
+# Pass --profile to prepare_payload.py, prepare_did_update.py, send_tx.py or report_tx.py and it will
+# write a cProfile of the run to profiles/<script>-<time>.prof, along with a text summary of the slowest calls.
+# You can look at the .prof file in more detail with python -m pstats or snakeviz.
+
+import os
+import sys
+import time
+import atexit
+import cProfile
+import pstats
+
+PROFILE_DIR = './profiles'
+
+# How many functions to list in the text summary
+SUMMARY_LINES = 40
+
+profiler = None
+
+def isEnabled():
+    return profiler is not None
+
+def startIfRequested():
+    # Call this before looking at sys.argv, it takes --profile out so the script's own argument handling doesn't see it
+    global profiler
+    if '--profile' not in sys.argv:
+        return
+    sys.argv.remove('--profile')
+    profiler = cProfile.Profile()
+    atexit.register(save)
+    profiler.enable()
+
+def save():
+    profiler.disable()
+    if not os.path.exists(PROFILE_DIR):
+        os.mkdir(PROFILE_DIR)
+    script = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    base = PROFILE_DIR + '/' + script + '-' + time.strftime('%Y%m%d-%H%M%S')
+    profiler.dump_stats(base + '.prof')
+    with open(base + '.txt', 'w') as f:
+        stats = pstats.Stats(profiler, stream=f)
+        stats.sort_stats('cumulative').print_stats(SUMMARY_LINES)
+    print("Profile written to " + base + ".prof")
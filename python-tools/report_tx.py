@@ -1,5 +1,3 @@
-import web3
-from eth_account import Account
 import os
 import json
 import time
@@ -9,21 +7,19 @@ import hashlib
 
 from atproto import Client, models, client_utils
 
-import skeet_queue
-
-from dotenv import load_dotenv
-
 from web3._utils.events import get_event_data
 
-DRY_RUN = False
+import skeet_queue
+import clients
+import metrics
+import timeline
+import profiling
+import retry_queue
 
-load_dotenv(dotenv_path='../contract/.env')
+DRY_RUN = False
 
 skeet_queue.prepare()
 
-url = os.getenv('SEPOLIA_RPC_URL')
-w3 = web3.Web3(web3.HTTPProvider(url))
-
 # Identifier in gnosis safe
 CHAIN_NAME = 'sep'
 
@@ -32,46 +28,85 @@ CHAIN_NAME = 'sep'
 # May also need abis not in this project
 ABI_PATH = './abi/'
 
-ABI_FILES = []
+BOT_LOGIN_FILE = "bot_login.json"
 
-if not os.path.exists(ABI_PATH):
-    print("Please create the abi/ directory and fill it with the ABIs you might need, eg with:")
-    print("pushd ../contract && forge build && popd")
-    print("mkdir abi && cp ../contract/out/*.sol/*.json abi/")
-    sys.exit(1)
-
-for f in os.listdir(ABI_PATH):
-    f_path = os.path.join(ABI_PATH, f)
-    if os.path.isfile(f_path):
-        ABI_FILES.append(f_path)
+# Loaded the first time we have something to report
+events_to_abi = None
+bot_login = None
+default_bot = None
 
-bot_login = {}
-with open("bot_login.json") as f:
-    bot_login = json.load(f)
+def eventsByTopic():
+    # Every event in the ABIs in abi/, by topic
+    global events_to_abi
+    if events_to_abi is not None:
+        return events_to_abi
+
+    if not os.path.exists(ABI_PATH):
+        print("Please create the abi/ directory and fill it with the ABIs you might need, eg with:")
+        print("pushd ../contract && forge build && popd")
+        print("mkdir abi && cp ../contract/out/*.sol/*.json abi/")
+        sys.exit(1)
+
+    events_to_abi = {}
+    for f in os.listdir(ABI_PATH):
+        abi_file = os.path.join(ABI_PATH, f)
+        if not os.path.isfile(abi_file):
+            continue
+        abi = clients.abi(abi_file)
+        for entry in abi:
+            if entry['type'] == 'event':
+                event = entry
+                name = event["name"]
+                inputs = [param["type"] for param in event["inputs"]]
+                inputs = ",".join(inputs)
+                event_signature_text = f"{name}({inputs})"
+                event_signature_hex = "0x" + clients.w3().keccak(text=event_signature_text).hex()
+                #print(event_signature_hex)
+                events_to_abi[event_signature_hex] = {
+                    'name': name,
+                    'contract': abi_file,
+                    'event': event,
+                    'abi': abi
+                }
+    return events_to_abi
+
+def botLogin():
+    # The accounts we can post as, and which one to use for bots we don't have a login for
+    global bot_login, default_bot
+    if bot_login is not None:
+        return bot_login, default_bot
+
+    with open(BOT_LOGIN_FILE) as f:
+        logins = json.load(f)
+
+    for b in logins:
+        if 'default' in logins[b] and logins[b]['default']:
+            default_bot = b
+            break
 
-default_bot = None
-for b in bot_login:
-    if 'default' in bot_login[b] and bot_login[b]['default']:
-        default_bot = b
-        break
+    if default_bot is None:
+        print('Could not find default bot. Please set "default": true for one entry in bot_login.json')
+        sys.exit()
 
-if default_bot is None:
-    print('Could not find default bot. Please set "default": true for one entry in bot_login.json')
-    sys.exit()
+    bot_login = logins
+    return bot_login, default_bot
 
 def processQueue():
-    while True:
-        item = skeet_queue.readNext("report")
-        if item is None:
-            break
+    # Take turns between bots so one busy bot doesn't hold up the others
+    for item in skeet_queue.readFair("report"):
         handleItem(item)
 
 def handleItem(item):
+    with metrics.timer('stage_seconds', {"stage": "report"}), timeline.running(item, "report"):
+        handleItemTimed(item)
+
+def handleItemTimed(item):
     at_uri = item['atURI']
     # print("handle item " + at_uri)
     bot = item['botName']
 
     if 'x_tx_hash' not in item and 'x_reply' not in item:
+        retry_queue.recordFailure(item, "report", "Item without tx hash or reply")
         skeet_queue.updateStatus(at_uri, bot, "report", "report_retry", item)
         print("Item without tx hash moved to report_retry")
         return
@@ -79,6 +114,7 @@ def handleItem(item):
     found_events_by_name = {}
     txid = None
 
+    bot_login, default_bot = botLogin()
     send_as_bot = default_bot
     if bot in bot_login:
         send_as_bot = bot
@@ -90,35 +126,12 @@ def handleItem(item):
         txid = item['x_tx_hash']
         etherscan_uri = 'https://sepolia.etherscan.io/tx/' + txid
 
+        w3 = clients.w3()
         tx = w3.eth.get_transaction(txid)
         receipt = w3.eth.get_transaction_receipt(txid)
         # print(receipt)
 
-        log_reports = {}
-        abi_contents = {}
-        events_to_abi = {}
-
-
-        for abi_file in ABI_FILES:
-            with open(abi_file) as f:
-                d = json.load(f)
-                abi_contents[abi_file] = d['abi']
-
-                for entry in d['abi']:
-                    if entry['type'] == 'event':
-                        event = entry
-                        name = event["name"]
-                        inputs = [param["type"] for param in event["inputs"]]
-                        inputs = ",".join(inputs)
-                        event_signature_text = f"{name}({inputs})"
-                        event_signature_hex = "0x" + w3.keccak(text=event_signature_text).hex()
-                        #print(event_signature_hex)
-                        events_to_abi[event_signature_hex] = {
-                            'name': name,
-                            'contract': abi_file,
-                            'event': event,
-                            'abi': d['abi']
-                        }
+        events_to_abi = eventsByTopic()
 
         for l in receipt.logs:
             # Encode and decode back to change the binary stuff into hex
@@ -173,16 +186,19 @@ def handleItem(item):
     if not DRY_RUN:
 
         client = Client(bot_login[send_as_bot]['serviceEndpoint'])
-        client.login(send_as_bot, bot_login[send_as_bot]['password'])
+        with metrics.timer('pds_request_seconds', {"call": "createSession"}):
+            client.login(send_as_bot, bot_login[send_as_bot]['password'])
 
-        post = client.app.bsky.feed.post.get(item['did'], item['rkey'])
+        with metrics.timer('pds_request_seconds', {"call": "getRecord"}):
+            post = client.app.bsky.feed.post.get(item['did'], item['rkey'])
 
         root_post_ref = models.create_strong_ref(post)
 
-        result = client.send_post(
-            text=message,
-            reply_to=models.AppBskyFeedPost.ReplyRef(parent=root_post_ref, root=root_post_ref),
-        )
+        with metrics.timer('pds_request_seconds', {"call": "createRecord"}):
+            result = client.send_post(
+                text=message,
+                reply_to=models.AppBskyFeedPost.ReplyRef(parent=root_post_ref, root=root_post_ref),
+            )
 
         item['x_report_uri'] = result['uri']
         print("Posted reply: " + result['uri'])
@@ -194,6 +210,8 @@ def handleItem(item):
 
 if __name__ == '__main__':
 
+    profiling.startIfRequested()
+
     if len(sys.argv) == 1:
         processQueue()
     else:
@@ -0,0 +1,152 @@
+# Moves items in the _retry queues back to be tried again, backing off each time, until we give up on them.
+
+# When a stage fails it moves the item to <stage>_retry and calls recordFailure() to note what went wrong in x_retry.
+# Each time this runs it looks at everything in the _retry queues:
+#  - Errors that will never go away, like an invalid proof or a deleted post, go straight to abandoned.
+#    Those are ones recordFailure() was told are terminal, or whose message matches TERMINAL_ERROR_HINTS.
+#  - Anything else is given a due time, with exponential backoff and some jitter so a batch that failed
+#    together doesn't all come back at once.
+#  - Once it's due it goes back to the stage queue, or to abandoned if it has already had RETRY_MAX_ATTEMPTS.
+# Only RETRY_MAX_PER_RUN items per stage go back each run, so a pile of failures can't crowd out fresh work.
+
+# x_retry is kept by stage, so an item that fails at tx after needing retries at payload starts again from zero.
+
+import os
+import time
+import random
+
+from dotenv import load_dotenv
+
+import skeet_queue
+import did_queue
+import metrics
+
+load_dotenv(dotenv_path='.env')
+
+STAGES = ['payload', 'tx', 'report']
+
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', 8))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 60))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 6 * 60 * 60))
+RETRY_MAX_PER_RUN = int(os.getenv('RETRY_MAX_PER_RUN', 20))
+
+# If the error contains one of these (ignoring case), trying again won't help.
+# Most are contract reverts saying the proof or the message itself is bad.
+# Other reverts are retried, since they may depend on things that can change, like a safe being funded
+# or the previous DID operation being registered. RETRY_MAX_ATTEMPTS stops us trying those forever.
+TERMINAL_ERROR_HINTS = [
+    'data field does not contain expected hash',
+    'v3 field not found',
+    'record key did not show a post',
+    'value does not match target',
+    'target entry not found in data node',
+    'message should begin with @',
+    'no space after bot name',
+    'signer should not be empty',
+    'signature did not match rotation key',
+    'suspicious uncompressed pubkey',
+    'newhash already registered',
+    # From payload_validator, for failures recorded before it raised InvalidPayload
+    'malformed cbor',
+    'fieldheader not found',
+    'did not recover a signer',
+    'do not match the path through the nodes',
+    'http error 404',
+    '404 client error',
+    'http error 410',
+    '410 client error',
+    'could not find',
+    'did not sign off',
+    'item without tx hash',
+]
+
+def retryState(item, stage):
+    if 'x_retry' not in item:
+        item['x_retry'] = {}
+    if stage not in item['x_retry']:
+        item['x_retry'][stage] = {"attempts": 0}
+    return item['x_retry'][stage]
+
+def recordFailure(item, stage, err, is_terminal=False):
+    # Call before moving the item to <stage>_retry.
+    # Pass is_terminal if the caller knows trying again won't help, so it is abandoned whatever the error says.
+    state = retryState(item, stage)
+    state['lastError'] = str(err)
+    if is_terminal:
+        state['isTerminal'] = True
+    else:
+        state.pop('isTerminal', None)
+    state['lastFailed'] = time.time()
+    # Work out when it's due next time the scheduler sees it
+    state.pop('nextDue', None)
+
+def isTerminal(error):
+    if error is None:
+        return False
+    error = error.lower()
+    for hint in TERMINAL_ERROR_HINTS:
+        if hint in error:
+            return True
+    return False
+
+def backoff(attempts):
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempts))
+    # Somewhere between half and all of the delay
+    return delay / 2 + random.uniform(0, delay / 2)
+
+QUEUES = [skeet_queue, did_queue]
+
+def schedule(queue, stage, now):
+    retry_status = stage + '_retry'
+    if retry_status not in queue.statuses:
+        return 0, 0
+
+    due = []
+    count_abandoned = 0
+    for item in queue.iterItems(retry_status):
+        state = retryState(item, stage)
+        key = queue.itemKey(item)
+        error = state.get('lastError')
+
+        if state.get('isTerminal', False) or isTerminal(error) or state['attempts'] >= RETRY_MAX_ATTEMPTS:
+            print("Abandoning " + " ".join(key) + " after " + str(state['attempts']) + " retries: " + str(error))
+            queue.updateStatus(*key, retry_status, 'abandoned', item)
+            metrics.inc('retry_abandoned_total', {"queue": queue.QUEUE_ROOT, "stage": stage})
+            count_abandoned = count_abandoned + 1
+            continue
+
+        if 'nextDue' not in state:
+            state['nextDue'] = now + backoff(state['attempts'])
+            queue.rewriteItem(*key, retry_status, item)
+            continue
+
+        if state['nextDue'] <= now:
+            due.append(item)
+
+    # Longest overdue first
+    due.sort(key=lambda item: item['x_retry'][stage]['nextDue'])
+    count_requeued = 0
+    for item in due[0:RETRY_MAX_PER_RUN]:
+        state = item['x_retry'][stage]
+        state['attempts'] = state['attempts'] + 1
+        del state['nextDue']
+        queue.updateStatus(*queue.itemKey(item), retry_status, stage, item)
+        metrics.inc('retry_requeued_total', {"queue": queue.QUEUE_ROOT, "stage": stage})
+        count_requeued = count_requeued + 1
+
+    if len(due) > RETRY_MAX_PER_RUN:
+        print(str(len(due) - RETRY_MAX_PER_RUN) + " more " + queue.QUEUE_ROOT + " " + retry_status + " items are due, leaving them for next time")
+
+    return count_requeued, count_abandoned
+
+if __name__ == '__main__':
+
+    skeet_queue.prepare()
+    did_queue.prepare()
+
+    now = time.time()
+    for queue in QUEUES:
+        for stage in STAGES:
+            count_requeued, count_abandoned = schedule(queue, stage, now)
+            if count_requeued > 0 or count_abandoned > 0:
+                print(queue.QUEUE_ROOT + " " + stage + ": requeued " + str(count_requeued) + ", abandoned " + str(count_abandoned))
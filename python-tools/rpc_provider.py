@@ -0,0 +1,11 @@
+# A web3 HTTP provider that records how many RPC calls we make and how long they take, by method.
+
+import web3
+
+import metrics
+
+class TimedHTTPProvider(web3.HTTPProvider):
+
+    def make_request(self, method, params):
+        with metrics.timer('rpc_request_seconds', {"method": str(method)}):
+            return super().make_request(method, params)
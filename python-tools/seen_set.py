@@ -0,0 +1,92 @@
+# Remembers which (at_uri, bot) pairs have ever been queued, so we can skip them without looking in every queue directory.
+
+# Items never leave the queue once they're in it, they only change status, so this only ever grows.
+# It's kept on disk as an append-only file of truncated hashes which we read into memory at startup.
+# A Bloom filter in front of the exact set answers the common "never seen it" case cheaply.
+# A Bloom filter hit is confirmed against the exact set, so we never get a false positive.
+
+import hashlib
+import math
+import os
+
+# Bytes of sha256 to keep per entry. 16 bytes is plenty to avoid collisions.
+ENTRY_BYTES = 16
+
+class BloomFilter:
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(capacity, 1024)
+        self.num_bits = int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+        self.capacity = capacity
+
+    def _positions(self, digest):
+        # Double hashing using two halves of an existing hash, see Kirsch & Mitzenmacher
+        h1 = int.from_bytes(digest[0:8], byteorder='big')
+        h2 = int.from_bytes(digest[8:16], byteorder='big') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, digest):
+        for pos in self._positions(digest):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count = self.count + 1
+
+    def __contains__(self, digest):
+        for pos in self._positions(digest):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+class SeenSet:
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.exact = set()
+        entries = []
+        if os.path.exists(index_file):
+            with open(index_file, 'rb') as f:
+                data = f.read()
+            # Ignore a partly-written entry at the end if we crashed mid-append
+            usable = len(data) - (len(data) % ENTRY_BYTES)
+            for i in range(0, usable, ENTRY_BYTES):
+                entries.append(data[i:i+ENTRY_BYTES])
+        self._rebuildBloom(len(entries) * 2)
+        for e in entries:
+            self._addInMemory(e)
+
+    def _rebuildBloom(self, capacity):
+        self.bloom = BloomFilter(capacity)
+        for e in self.exact:
+            self.bloom.add(e)
+
+    def _addInMemory(self, digest):
+        if digest in self.exact:
+            return
+        self.exact.add(digest)
+        if self.bloom.count >= self.bloom.capacity:
+            self._rebuildBloom(self.bloom.capacity * 2)
+        else:
+            self.bloom.add(digest)
+
+    def digest(self, key):
+        return hashlib.sha256(key.encode()).digest()[0:ENTRY_BYTES]
+
+    def __contains__(self, key):
+        d = self.digest(key)
+        if d not in self.bloom:
+            return False
+        return d in self.exact
+
+    def __len__(self):
+        return len(self.exact)
+
+    def add(self, key):
+        d = self.digest(key)
+        if d in self.exact:
+            return
+        with open(self.index_file, 'ab') as f:
+            f.write(d)
+        self._addInMemory(d)
@@ -0,0 +1,113 @@
+# Keeps finished queue items in a few large compressed files instead of one file each.
+
+# Each item is compressed on its own and appended to the current segment file, so any one item can be read back
+# by seeking to it, without decompressing the rest. Segments are only ever appended to, and a new one is started
+# once the current one reaches SEGMENT_MAX_BYTES.
+# Where each item is goes in an SQLite index next to the segments.
+
+# If we die after appending but before the index is committed, the bytes we appended are never referenced
+# and the item is still in the queue directory, so it gets archived again next time.
+
+import os
+import gzip
+import sqlite3
+
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+
+class SegmentArchive:
+
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self.conn = None
+
+    def connection(self):
+        if self.conn is None:
+            if not os.path.exists(self.archive_dir):
+                os.makedirs(self.archive_dir, exist_ok=True)
+            self.conn = sqlite3.connect(self.archive_dir + '/index.sqlite')
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS items (
+                    name TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    segment INTEGER NOT NULL,
+                    offset INTEGER NOT NULL,
+                    length INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS items_by_status ON items (status, segment, offset);
+            """)
+        return self.conn
+
+    def segmentFile(self, segment):
+        return self.archive_dir + '/segment-' + str(segment).zfill(6) + '.gz'
+
+    def currentSegment(self):
+        row = self.connection().execute('SELECT max(segment) FROM items').fetchone()
+        segment = row[0] if row[0] is not None else 1
+        segment_file = self.segmentFile(segment)
+        if os.path.exists(segment_file) and os.path.getsize(segment_file) >= SEGMENT_MAX_BYTES:
+            segment = segment + 1
+        return segment
+
+    def add(self, items):
+        # Archive a list of (name, status, data bytes), in one append and one commit
+        if len(items) == 0:
+            return
+        segment = self.currentSegment()
+        rows = []
+        with open(self.segmentFile(segment), 'ab') as f:
+            offset = f.tell()
+            for name, status, data in items:
+                compressed = gzip.compress(data)
+                f.write(compressed)
+                rows.append((name, status, segment, offset, len(compressed)))
+                offset = offset + len(compressed)
+            f.flush()
+            os.fsync(f.fileno())
+        self.connection().executemany(
+            'INSERT OR REPLACE INTO items (name, status, segment, offset, length) VALUES (?, ?, ?, ?, ?)',
+            rows
+        )
+        self.connection().commit()
+
+    def status(self, name):
+        row = self.connection().execute('SELECT status FROM items WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _read(self, segment, offset, length):
+        with open(self.segmentFile(segment), 'rb') as f:
+            f.seek(offset)
+            return gzip.decompress(f.read(length))
+
+    def read(self, name):
+        row = self.connection().execute('SELECT segment, offset, length FROM items WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        return self._read(row[0], row[1], row[2])
+
+    def remove(self, name):
+        # Forget an item, eg because it has been moved back into the queue. Its bytes stay in the segment.
+        self.connection().execute('DELETE FROM items WHERE name = ?', (name,))
+        self.connection().commit()
+
+    def count(self, status):
+        return self.connection().execute('SELECT count(*) FROM items WHERE status = ?', (status,)).fetchone()[0]
+
+    def names(self, status=None):
+        if status is None:
+            cur = self.connection().execute('SELECT name FROM items')
+        else:
+            cur = self.connection().execute('SELECT name FROM items WHERE status = ?', (status,))
+        for row in cur:
+            yield row[0]
+
+    def iterItems(self, status):
+        # Yields (name, data bytes) in the order they're stored, so we read each segment front to back
+        rows = self.connection().execute(
+            'SELECT name, segment, offset, length FROM items WHERE status = ? ORDER BY segment, offset',
+            (status,)
+        ).fetchall()
+        for name, segment, offset, length in rows:
+            yield name, self._read(segment, offset, length)
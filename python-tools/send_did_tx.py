@@ -1,7 +1,5 @@
 import web3
-from eth_account import Account
 import os
-import json
 import time
 import sys
 
@@ -10,53 +8,98 @@ import libipld
 import binascii
 
 import did_queue
+import multicall
+import clients
+import metrics
+import timeline
+import retry_queue
 
-from dotenv import load_dotenv
-
-load_dotenv(dotenv_path='../contract/.env')
+from web3.logs import DISCARD
 
 did_queue.prepare()
 
-url = os.getenv('SEPOLIA_RPC_URL')
-w3 = web3.Web3(web3.HTTPProvider(url))
-
-SHADOW_DID_ADDRESS = os.getenv('SHADOW_DID')
-
-ABI_FILE = "../contract/out/ShadowDIDPLCDirectory.sol/ShadowDIDPLCDirectory.json"
-ACCOUNT = Account.from_key(os.getenv('PRIVATE_KEY'))
-
-with open(ABI_FILE) as f:
-    d = json.load(f)
-
-SHADOW_DID_ABI = d['abi']
+# How many DIDs to update in one transaction, DID_TX_BATCH_SIZE in ../contract/.env
+DEFAULT_DID_TX_BATCH_SIZE = 20
 
-directory = w3.eth.contract(address=SHADOW_DID_ADDRESS, abi=SHADOW_DID_ABI)
+# The last operation we know is recorded in the directory for each DID, so next time we can start from there
+SHADOW_CACHE = './shadow'
 
 def arrToBytesArr(arr):
     ret = []
     for item in arr:
-        ret.append(w3.to_bytes(hexstr=item))
+        ret.append(clients.w3().to_bytes(hexstr=item))
     return ret
 
+def recordedCacheFile(did):
+    # Keyed by directory address too, so a new deployment doesn't pick up the old one's state
+    return SHADOW_CACHE + '/' + hashlib.sha256((clients.shadowDidAddress() + did).encode()).hexdigest()
+
+def loadRecordedHash(did):
+    cache_file = recordedCacheFile(did)
+    if not os.path.exists(cache_file):
+        return None
+    with open(cache_file) as f:
+        return bytes.fromhex(f.read().strip())
+
+def saveRecordedHash(did, update_hash):
+    if not os.path.exists(SHADOW_CACHE):
+        os.mkdir(SHADOW_CACHE)
+    with open(recordedCacheFile(did), 'w') as f:
+        f.write(update_hash.hex())
+
+def isRecorded(did_bytes, update_hash):
+    ts = clients.directory().functions.opRecordedTimestamp(did_bytes, update_hash).call()
+    print("ts is "+str(ts))
+    return ts > 0
+
+def countRecorded(did, did_bytes, update_hashes):
+    # Each op has to be registered on top of the previous one, so the recorded ops are always at the start.
+    # That means we can binary search for the first one that isn't recorded.
+    # Everything before lo is recorded, and the op at hi (if there is one) isn't.
+    lo = 0
+    hi = len(update_hashes)
+
+    cached_hash = loadRecordedHash(did)
+    is_cache_hit = cached_hash is not None and cached_hash in update_hashes
+    metrics.cacheResult('shadow_recorded', is_cache_hit)
+    if is_cache_hit:
+        lo = update_hashes.index(cached_hash) + 1
+
+    # Usually either nothing is new, or only the last op is, so check the ends first
+    if lo < hi:
+        if isRecorded(did_bytes, update_hashes[hi-1]):
+            lo = hi
+        else:
+            hi = hi - 1
+            if lo < hi and not isRecorded(did_bytes, update_hashes[lo]):
+                hi = lo
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if isRecorded(did_bytes, update_hashes[mid]):
+            lo = mid + 1
+        else:
+            hi = mid
+
+    if lo > 0:
+        saveRecordedHash(did, update_hashes[lo-1])
+    return lo
+
 def filterToNecessary(payload):
     # if we have an update already, we don't need the did
     # did_hex = binascii.hexlify(payload['did'].encode('utf-8'))
     did_bytes = payload['did'].encode('utf-8')
 
-    skip_entries = 0
-    is_genesis_recorded = False
-
     if len(payload['ops']) == 0:
         return None, None
 
+    update_hashes = []
     for op in payload['ops']:
-        op_bytes = w3.to_bytes(hexstr=op)
-        update_hash = hashlib.sha256(op_bytes).digest()
-        ts = directory.functions.opRecordedTimestamp(did_bytes, update_hash).call()
-        print("ts is "+str(ts))
-        if ts > 0:
-            is_genesis_recorded = True
-            skip_entries = skip_entries + 1
+        op_bytes = clients.w3().to_bytes(hexstr=op)
+        update_hashes.append(hashlib.sha256(op_bytes).digest())
+
+    skip_entries = countRecorded(payload['did'], did_bytes, update_hashes)
+    is_genesis_recorded = skip_entries > 0
 
     if skip_entries == len(payload['ops']):
         return None, None
@@ -78,7 +121,7 @@ def filterToNecessary(payload):
 
     # New entries should have a did of 0x0
     if not is_genesis_recorded:
-        did_bytes = w3.to_bytes(hexstr="0x0000000000000000000000000000000000000000000000000000000000000000")
+        did_bytes = clients.w3().to_bytes(hexstr="0x0000000000000000000000000000000000000000000000000000000000000000")
 
     return (payload, did_bytes)
 
@@ -88,6 +131,10 @@ def sendTX(item):
         print("Nothing to do")
         return None, None
 
+    w3 = clients.w3()
+    account = clients.account()
+    directory = clients.directory()
+
     print(payload)
     tx = None
     did_hex = binascii.hexlify(payload['did'].encode('utf-8'))
@@ -105,23 +152,25 @@ def sendTX(item):
             arrToBytesArr(payload['pubkeys']),
             payload['pubkeyIndexes'],
         ).build_transaction({
-            "from": ACCOUNT.address,
-            "nonce": w3.eth.get_transaction_count(ACCOUNT.address),
+            "from": account.address,
+            "nonce": w3.eth.get_transaction_count(account.address),
         })
         gas = w3.eth.estimate_gas(tx)
     except web3.exceptions.ContractLogicError as err:
         return (False, err.message)
-    signed_tx = w3.eth.account.sign_transaction(tx, private_key=ACCOUNT.key).raw_transaction
+    signed_tx = w3.eth.account.sign_transaction(tx, private_key=account.key).raw_transaction
     tx_hash = w3.eth.send_raw_transaction(signed_tx)
     receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
+    metrics.inc('did_gas_used_total', None, receipt.gasUsed)
+    metrics.inc('did_transactions_total')
     return (True, receipt)
 
 def diagnosisDetail(item):
     return {}
     commit_node = bytes.fromhex(item['commitNode'][2:])
     sighash = hashlib.sha256(commit_node).digest()
-    balance = w3.eth.get_balance(signer_safe)
-    code_len = len(w3.eth.get_code(signer_safe))
+    balance = clients.w3().eth.get_balance(signer_safe)
+    code_len = len(clients.w3().eth.get_code(signer_safe))
     is_deployed = False
     if code_len > 0:
         is_deployed = True
@@ -132,16 +181,123 @@ def diagnosisDetail(item):
         'isDeployed': is_deployed 
     }
 
+def registerUpdatesArgs(payload, did_param):
+    return [
+        did_param,
+        arrToBytesArr(payload['ops']),
+        arrToBytesArr(payload['sigs']),
+        arrToBytesArr(payload['pubkeys']),
+        payload['pubkeyIndexes'],
+    ]
+
+def sendBatch(items):
+    # Registers updates for several DIDs in one transaction using Multicall3.
+    # Returns (result, detail) for each item, like sendTX does.
+    w3 = clients.w3()
+    account = clients.account()
+    directory = clients.directory()
+    results = {}
+    calls = []
+    call_dids = []
+    last_op_hashes = {}
+    for item in items:
+        payload, did_param = filterToNecessary(item)
+        if payload is None:
+            print("Nothing to do for " + item['did'])
+            results[item['did']] = (None, None)
+            continue
+        calls.append(multicall.encodeCall(directory, 'registerUpdates', registerUpdatesArgs(payload, did_param)))
+        call_dids.append(item['did'])
+        last_op_hashes[item['did']] = hashlib.sha256(w3.to_bytes(hexstr=payload['ops'][-1])).digest()
+
+    if len(calls) == 0:
+        return results
+
+    # Simulate them all in one eth_call, and leave out any that would fail
+    simulated = multicall.aggregate(w3, calls)
+    send_calls = []
+    send_dids = []
+    for i in range(len(calls)):
+        success, return_data = simulated[i]
+        if success:
+            send_calls.append(calls[i])
+            send_dids.append(call_dids[i])
+        else:
+            results[call_dids[i]] = (False, multicall.revertReason(w3, return_data))
+
+    if len(send_calls) == 0:
+        return results
+
+    try:
+        tx = multicall.contract(w3).functions.aggregate3(send_calls).build_transaction({
+            "from": account.address,
+            "nonce": w3.eth.get_transaction_count(account.address),
+        })
+    except web3.exceptions.ContractLogicError as err:
+        for did in send_dids:
+            results[did] = (False, err.message)
+        return results
+    except web3.exceptions.Web3RPCError as err:
+        # Eg the batch needs more gas than a block allows, so send the ones that passed the simulation in two halves
+        if len(send_dids) == 1:
+            results[send_dids[0]] = (False, err.message)
+            return results
+        print("Could not send a batch of " + str(len(send_dids)) + ", splitting it: " + err.message)
+        send_items = [item for item in items if item['did'] in send_dids]
+        half = len(send_items) // 2
+        results.update(sendBatch(send_items[:half]))
+        results.update(sendBatch(send_items[half:]))
+        return results
+    signed_tx = w3.eth.account.sign_transaction(tx, private_key=account.key).raw_transaction
+    tx_hash = w3.eth.send_raw_transaction(signed_tx)
+    receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
+    metrics.inc('did_gas_used_total', None, receipt.gasUsed)
+    metrics.inc('did_transactions_total')
+
+    # Failures are allowed so one bad DID can't sink the others, so check each one made it from the logs
+    registered_hashes = set()
+    for log in directory.events.LogRegisterUpdate().process_receipt(receipt, errors=DISCARD):
+        registered_hashes.add(log['args']['newHash'])
+    for did in send_dids:
+        if last_op_hashes[did] in registered_hashes:
+            results[did] = (True, receipt)
+        else:
+            results[did] = (False, 'Not registered in batch transaction ' + receipt.transactionHash.to_0x_hex())
+    return results
+
 def processQueue():
+    if not multicall.isAvailable(clients.w3()):
+        print("Multicall3 not found at " + multicall.address() + ", sending one transaction per DID")
+        while True:
+            item = did_queue.readNext("tx")
+            if item is None:
+                break
+            handleItem(item)
+        return
+
+    batch_size = int(clients.config('DID_TX_BATCH_SIZE', DEFAULT_DID_TX_BATCH_SIZE))
     while True:
-        item = did_queue.readNext("tx")
-        if item is None:
+        items = did_queue.readItems("tx", batch_size)
+        if len(items) == 0:
             break
-        handleItem(item)
+        start = time.monotonic()
+        with timeline.running(items, "tx"):
+            results = sendBatch(items)
+            # Every DID in the batch waited for the whole batch
+            elapsed = time.monotonic() - start
+            for item in items:
+                metrics.observe('stage_seconds', elapsed, {"stage": "did_tx"})
+                result, detail = results[item['did']]
+                recordResult(item, result, detail)
 
 def handleItem(item):
+    with timeline.running(item, "tx"):
+        with metrics.timer('stage_seconds', {"stage": "did_tx"}):
+            result, detail = sendTX(item)
+        recordResult(item, result, detail)
+
+def recordResult(item, result, detail):
     did = item['did']
-    result, detail = sendTX(item)
     if not 'x_history' in item:
         item['x_history'] = [] 
     item['x_history'].append({
@@ -154,11 +310,16 @@ def handleItem(item):
         item['x_tx_hash'] = detail.transactionHash.to_0x_hex()
         did_queue.updateStatus(did, "tx", "report", item)
     else:
-        if detail == 'execution reverted: Already handled':
+        if result is None:
+            # filterToNecessary found everything was already recorded
+            print("Nothing to send, already recorded: " + did)
+            did_queue.updateStatus(did, "tx", "report", item)
+        elif detail == 'execution reverted: Already handled':
             print("Was already completed: " + did)
             did_queue.updateStatus(did, "tx", "report", item)
         else:
             print("Failed, queued for retry: " + did)
+            retry_queue.recordFailure(item, "tx", detail)
             did_queue.updateStatus(did, "tx", "tx_retry", item)
 
 if __name__ == '__main__':
@@ -1,114 +1,68 @@
-import web3
-from eth_account import Account
-import os
 import json
 import time
 import sys
 
-import hashlib
-
 import skeet_queue
-
-from dotenv import load_dotenv
-
-load_dotenv(dotenv_path='../contract/.env')
+import skeet_gateway
+import clients
+import metrics
+import timeline
+import profiling
+import retry_queue
+import payload_validator
 
 skeet_queue.prepare()
 
-url = os.getenv('SEPOLIA_RPC_URL')
-w3 = web3.Web3(web3.HTTPProvider(url))
-
-GATEWAY_ADDRESS = os.getenv('SKEET_GATEWAY')
-
-ABI_FILE = "../contract/out/SkeetGateway.sol/SkeetGateway.json"
-ACCOUNT = Account.from_key(os.getenv('PRIVATE_KEY'))
-
-with open(ABI_FILE) as f:
-    d = json.load(f)
-
-GATEWAY_ABI = d['abi']
-
-gateway = w3.eth.contract(address=GATEWAY_ADDRESS, abi=GATEWAY_ABI)
-
-def arrToBytesArr(arr):
-    ret = []
-    for item in arr:
-        ret.append(w3.to_bytes(hexstr=item))
-    return ret
-
-def sendTX(item):
-    #payload = item['payload']
-    payload = item
-    tx = None
-    try:
-        tx = gateway.functions.handleSkeet(
-            arrToBytesArr(payload['content']),
-            int(payload['botNameLength']),
-            arrToBytesArr(payload['nodes']),
-            payload['nodeHints'],
-            w3.to_bytes(hexstr=payload['commitNode']),
-            w3.to_bytes(hexstr=payload['sig']),
-        ).build_transaction({
-            "from": ACCOUNT.address,
-            "nonce": w3.eth.get_transaction_count(ACCOUNT.address),
-        })
-        gas = w3.eth.estimate_gas(tx)
-        print("Gas estimate: " + str(gas))
-    except (web3.exceptions.ContractLogicError, web3.exceptions.Web3RPCError) as err:
-        return (False, None, err)
-    signed_tx = w3.eth.account.sign_transaction(tx, private_key=ACCOUNT.key).raw_transaction
-    tx_hash = w3.eth.send_raw_transaction(signed_tx)
-    receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
-    return (True, receipt, None)
-
-def diagnosisDetail(item):
-    commit_node = bytes.fromhex(item['commitNode'][2:])
-    sighash = hashlib.sha256(commit_node).digest()
-    signer = gateway.functions.predictSignerAddressFromSig(sighash, item['sig']).call()
-    did_bytes = item['did'].encode('utf-8')
-    signer_safe = gateway.functions.predictSafeAddressFromDidAndSig(did_bytes, sighash, item['sig'], 0).call()
-    balance = w3.eth.get_balance(signer_safe)
-    code_len = len(w3.eth.get_code(signer_safe))
-    is_deployed = False
-    if code_len > 0:
-        is_deployed = True
-    return {
-        'signer': signer,
-        'signerSafe': signer_safe,
-        'balance': balance,
-        'isDeployed': is_deployed 
-    }
-
 def processQueue():
-    while True:
-        item = skeet_queue.readNext("tx")
-        if item is None:
-            break
+    # Take turns between bots so one busy bot doesn't hold up the others
+    for item in skeet_queue.readFair("tx"):
         handleItem(item)
 
 def handleItem(item):
+    with metrics.timer('stage_seconds', {"stage": "tx"}), timeline.running(item, "tx"):
+        handleItemTimed(item)
+
+def handleItemTimed(item):
     at_uri = item['atURI']
     bot = item['botName']
     #print(at_uri)
-    result, detail, err = sendTX(item)
+    # Don't spend RPC calls or gas on something the gateway would reject anyway
+    try:
+        payload_validator.validatePayload(item)
+    except payload_validator.InvalidPayload as err:
+        # retry_queue.py will move it to abandoned
+        print("Invalid payload, not retrying: " + at_uri + " (" + bot + "): " + str(err))
+        metrics.inc('payloads_rejected_total', {"bot": bot})
+        retry_queue.recordFailure(item, "tx", err, is_terminal=True)
+        skeet_queue.updateStatus(at_uri, bot, "tx", "tx_retry", item)
+        return
+    except Exception as err:
+        print("Could not validate payload, queued for retry: " + at_uri + " (" + bot + "): " + str(err))
+        metrics.inc('payloads_rejected_total', {"bot": bot})
+        retry_queue.recordFailure(item, "tx", err)
+        skeet_queue.updateStatus(at_uri, bot, "tx", "tx_retry", item)
+        return
+    result, detail, err = skeet_gateway.sendTX(item)
     # print("detail is")
     # print(detail)
     if not 'x_history' in item:
         item['x_history'] = [] 
     item['x_history'].append({
         str(time.time()): {
-            "diagnosis": diagnosisDetail(item),
+            "diagnosis": skeet_gateway.diagnosisDetail(item),
             "error": str(err)
         }
     })
     if result:
         print("Completed: " + at_uri + " (" + bot + ")")
         item['x_tx_hash'] = detail.transactionHash.to_0x_hex()
+        metrics.inc('gas_used_total', {"bot": bot}, detail.gasUsed)
+        metrics.inc('transactions_total', {"bot": bot})
         item['x_tx_logs'] = []
         #print(detail.logs)
         for l in detail.logs:
             # Encode and decode back to change the binary stuff into stuff that can go to json
-            json_friendly_obj = json.loads(w3.to_json(l))
+            json_friendly_obj = json.loads(clients.w3().to_json(l))
             item['x_tx_logs'].append(json_friendly_obj)
         skeet_queue.updateStatus(at_uri, bot, "tx", "report", item)
     else:
@@ -117,10 +71,13 @@ def handleItem(item):
             skeet_queue.updateStatus(at_uri, bot, "tx", "report", item)
         else:
             print("Failed, queued for retry: " + at_uri + " (" + bot + ")")
+            retry_queue.recordFailure(item, "tx", err)
             skeet_queue.updateStatus(at_uri, bot, "tx", "tx_retry", item)
 
 if __name__ == '__main__':
 
+    profiling.startIfRequested()
+
     if len(sys.argv) == 1:
         processQueue()
     else:
@@ -0,0 +1,86 @@
+# Rules for deciding from the text of a post whether a bot could do anything with it.
+
+# These work on the record as a dict in the same shape we get it out of the CAR file, ie with "$type" and "byteStart".
+# fetch_skeets.py uses them on the record the search API already gave us, so that posts nothing will happen to
+# can be ignored without fetching their DID document or CAR file.
+# prepare_payload.py uses the same rules once it has the CAR file, so the two can't disagree.
+
+import re
+
+PAY_BOT = 'pay.skeetbot.eth.link'
+
+# SkeetGateway takes the length as a uint8, and prepare_payload.py won't go over 100
+MAX_BOT_NAME_LENGTH = 100
+
+# Anything longer than this won't fit in the amount the pay parser will handle
+MAX_AMOUNT_LENGTH = 18
+
+MENTION_TYPE = 'app.bsky.richtext.facet#mention'
+
+def isAmount(poss_num):
+    if len(poss_num) > MAX_AMOUNT_LENGTH:
+        return False
+    pattern1 = re.compile(r'^\d+$')
+    pattern2 = re.compile(r'^\d+\.\d+$')
+    return bool(pattern1.match(poss_num) or pattern2.match(poss_num))
+
+def isPayCommand(text):
+    # @<bot> <amount> ETH ...
+    if not text.startswith('@'):
+        return False
+
+    message_bits = text.split()
+    if len(message_bits) < 3:
+        return False
+
+    if message_bits[0][0:1] != '@':
+        return False
+
+    if not isAmount(message_bits[1]):
+        return False
+
+    return message_bits[2] == 'ETH'
+
+def isAddressedTo(text, bot):
+    # SkeetGateway looks the bot up from the name after the @ and needs a space straight after it
+    if len(bot) == 0 or len(bot) > MAX_BOT_NAME_LENGTH:
+        return False
+    return text.startswith('@' + bot + ' ')
+
+def otherMentionDids(record, bot):
+    # DIDs mentioned in the post, except for mentions of the bot itself.
+    # We can tell which mention is the bot from the text the facet covers, without looking up its DID.
+    dids = []
+    text_bytes = record.get('text', '').encode('utf-8')
+    bot_mention = ('@' + bot).encode('utf-8')
+    for facet in record.get('facets') or []:
+        mentioned = text_bytes[facet['index']['byteStart']:facet['index']['byteEnd']]
+        for feature in facet['features']:
+            if feature.get('$type') != MENTION_TYPE:
+                continue
+            if mentioned == bot_mention:
+                continue
+            dids.append(feature['did'])
+    return dids
+
+def classifyRecord(bot, record, is_reply_parent_needed):
+    # Returns None if a bot could act on the post, or the reason it can't
+    text = record.get('text', '')
+
+    if bot == PAY_BOT:
+        if isAddressedTo(text, bot) and isPayCommand(text):
+            return None
+        # Not a payment, but if it mentions someone we can reply with the address to pay them at
+        if len(otherMentionDids(record, bot)) > 0:
+            return None
+        return 'not a payment and no one to pay'
+
+    if not isAddressedTo(text, bot):
+        return 'does not begin with @' + bot
+
+    if is_reply_parent_needed:
+        reply = record.get('reply')
+        if reply is None or 'parent' not in reply:
+            return 'bot needs the reply parent but the post is not a reply'
+
+    return None
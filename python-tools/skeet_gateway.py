@@ -1,58 +1,51 @@
 import web3
-from eth_account import Account
-import os
-import json
-import time
-import sys
-
 import hashlib
 
-import skeet_queue
-
-from dotenv import load_dotenv
-
-load_dotenv(dotenv_path='../contract/.env')
-
-skeet_queue.prepare()
-
-url = os.getenv('SEPOLIA_RPC_URL')
-w3 = web3.Web3(web3.HTTPProvider(url))
-
-GATEWAY_ADDRESS = os.getenv('SKEET_GATEWAY')
-
-ABI_FILE = "../contract/out/SkeetGateway.sol/SkeetGateway.json"
-ACCOUNT = Account.from_key(os.getenv('PRIVATE_KEY'))
-
-with open(ABI_FILE) as f:
-    d = json.load(f)
-
-GATEWAY_ABI = d['abi']
-
-gateway = w3.eth.contract(address=GATEWAY_ADDRESS, abi=GATEWAY_ABI)
+import clients
+import multicall
 
+is_multicall_available = None
 
 def selectedSafeAddress(did, addr):
     did_bytes = did.encode('utf-8')
     print(did_bytes)
     print(addr)
-    return gateway.functions.selectedSafeAddress(did_bytes, addr).call()
+    return clients.gateway().functions.selectedSafeAddress(did_bytes, addr).call()
+
+def selectedSafeAddresses(did_addrs):
+    # selectedSafeAddress() for a list of (did, addr), in a single eth_call if Multicall3 is there
+    global is_multicall_available
+    if len(did_addrs) == 0:
+        return []
+    w3 = clients.w3()
+    if is_multicall_available is None:
+        is_multicall_available = multicall.isAvailable(w3)
+    if len(did_addrs) == 1 or not is_multicall_available:
+        return [selectedSafeAddress(did, addr) for did, addr in did_addrs]
+    gateway = clients.gateway()
+    calls = [multicall.encodeCall(gateway, 'selectedSafeAddress', [did.encode('utf-8'), addr]) for did, addr in did_addrs]
+    safe_addrs = []
+    for success, return_data in multicall.aggregate(w3, calls):
+        if not success:
+            raise Exception("selectedSafeAddress failed: " + multicall.revertReason(w3, return_data))
+        # decodeResult gives lower case addresses, where the contract call gives them checksummed
+        safe_addrs.append(web3.Web3.to_checksum_address(multicall.decodeResult(gateway, 'selectedSafeAddress', return_data)))
+    return safe_addrs
 
 def arrToBytesArr(arr):
     ret = []
     for item in arr:
-        ret.append(w3.to_bytes(hexstr=item))
+        ret.append(clients.w3().to_bytes(hexstr=item))
     return ret
 
-
-# TODO: These are copied from send_tx.py
-# Remove them from send_tx.py and import them from here instead
-
 def sendTX(item):
     #payload = item['payload']
     payload = item
     tx = None
+    w3 = clients.w3()
+    account = clients.account()
     try:
-        tx = gateway.functions.handleSkeet(
+        tx = clients.gateway().functions.handleSkeet(
             arrToBytesArr(payload['content']),
             int(payload['botNameLength']),
             arrToBytesArr(payload['nodes']),
@@ -60,19 +53,21 @@ def sendTX(item):
             w3.to_bytes(hexstr=payload['commitNode']),
             w3.to_bytes(hexstr=payload['sig']),
         ).build_transaction({
-            "from": ACCOUNT.address,
-            "nonce": w3.eth.get_transaction_count(ACCOUNT.address),
+            "from": account.address,
+            "nonce": w3.eth.get_transaction_count(account.address),
         })
         gas = w3.eth.estimate_gas(tx)
         print("Gas estimate: " + str(gas))
     except (web3.exceptions.ContractLogicError, web3.exceptions.Web3RPCError) as err:
         return (False, None, err)
-    signed_tx = w3.eth.account.sign_transaction(tx, private_key=ACCOUNT.key).raw_transaction
+    signed_tx = w3.eth.account.sign_transaction(tx, private_key=account.key).raw_transaction
     tx_hash = w3.eth.send_raw_transaction(signed_tx)
     receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
     return (True, receipt, None)
 
 def diagnosisDetail(item):
+    w3 = clients.w3()
+    gateway = clients.gateway()
     commit_node = bytes.fromhex(item['commitNode'][2:])
     sighash = hashlib.sha256(commit_node).digest()
     signer = gateway.functions.predictSignerAddressFromSig(sighash, item['sig']).call()
@@ -87,5 +82,5 @@ def diagnosisDetail(item):
         'signer': signer,
         'signerSafe': signer_safe,
         'balance': balance,
-        'isDeployed': is_deployed 
+        'isDeployed': is_deployed
     }
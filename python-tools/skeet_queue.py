@@ -1,64 +1,324 @@
+import collections
 import hashlib
 import json
 import os
+import time
 from pathvalidate import sanitize_filename
 
+from seen_set import SeenSet
+from segment_archive import SegmentArchive
+from blob_store import BlobStore
+import timeline
+import bot_registry
+
 statuses = ['ignored', 'payload', 'payload_retry', 'tx', 'tx_retry', 'report', 'report_retry', 'abandoned', 'completed']
 
 QUEUE_ROOT = "skeet_queue"
 
+# Every item we have ever queued, in any status
+SEEN_INDEX = QUEUE_ROOT + '/seen.idx'
+
+seen = None
+
+# Items are kept in a subdirectory named after the start of the hash of their filename,
+# so no one directory gets too big to list or look things up in.
+SHARD_LENGTH = 2
+
+# Statuses items never leave, which compact() moves out of the directories into an archive of compressed segments
+ARCHIVED_STATUSES = ['completed', 'ignored']
+ARCHIVE_DIR = QUEUE_ROOT + '/archive'
+
+segment_archive = None
+
+# Big parts of an item that don't change once they're set, which we keep in the blob store instead of the item file
+BLOB_FIELDS = ['content', 'nodes', 'x_tx_logs']
+blobs = BlobStore(QUEUE_ROOT + '/blobs')
+
+# Per-bot weights and caps for readFair(), see bot_schedule.example.json
+SCHEDULE_CONFIG = 'bot_schedule.json'
+
 def prepare():
     if not os.path.exists(QUEUE_ROOT):
         os.mkdir(QUEUE_ROOT)
     for s in statuses:
         if not os.path.exists(QUEUE_ROOT + '/' + s):
             os.mkdir(QUEUE_ROOT + '/' + s)
+        # Items from before we sharded are directly in the status directory, so move them into their shard
+        with os.scandir(QUEUE_ROOT + '/' + s) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    os.makedirs(itemDir(s, entry.name), exist_ok=True)
+                    os.rename(entry.path, itemFile(s, entry.name))
+
+def shard(fn):
+    return hashlib.sha256(fn.encode()).hexdigest()[0:SHARD_LENGTH]
+
+def itemDir(status, fn):
+    return QUEUE_ROOT + '/' + status + '/' + shard(fn)
+
+def itemFile(status, fn):
+    return itemDir(status, fn) + '/' + fn
+
+def listEntries(status):
+    # os.DirEntry for each item file with the status
+    with os.scandir(QUEUE_ROOT + '/' + status) as shards:
+        for shard_entry in shards:
+            if not shard_entry.is_dir():
+                continue
+            with os.scandir(shard_entry.path) as entries:
+                for entry in entries:
+                    yield entry
+
+def writeItem(status, fn, item):
+    # Written somewhere else then moved into place, so nothing reading the queue can see it half written
+    os.makedirs(itemDir(status, fn), exist_ok=True)
+    tmp_file = QUEUE_ROOT + '/.' + fn + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(blobs.pack(item, BLOB_FIELDS), f, indent=4)
+    os.replace(tmp_file, itemFile(status, fn))
+
+def loadItem(item_file):
+    with open(item_file) as f:
+        return blobs.unpack(json.load(f))
+
+def archive():
+    global segment_archive
+    if segment_archive is None:
+        segment_archive = SegmentArchive(ARCHIVE_DIR)
+    return segment_archive
+
+def isArchiveCreated():
+    # So we don't create an empty archive just to look in it
+    return segment_archive is not None or os.path.exists(ARCHIVE_DIR)
+
+def itemKey(item):
+    # The arguments that identify the item to the other functions here
+    return (item['atURI'], item['botName'])
 
 def hashedName(at_uri, bot):
     fn = bot + '-' + at_uri
     return sanitize_filename(fn)
 
+def seenSet():
+    global seen
+    if seen is None:
+        if not os.path.exists(SEEN_INDEX):
+            # First run with the index, so fill it from whatever is already queued.
+            # It's built under another name and only moved into place once it's complete,
+            # since if we crashed partway through we'd never finish it and would queue things twice.
+            tmp_file = SEEN_INDEX + '.tmp'
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+            new_index = SeenSet(tmp_file)
+            for s in statuses:
+                for entry in listEntries(s):
+                    new_index.add(entry.name)
+            if isArchiveCreated():
+                for fn in archive().names():
+                    new_index.add(fn)
+            # An empty queue leaves nothing written, but the index should still exist
+            open(tmp_file, 'ab').close()
+            os.replace(tmp_file, SEEN_INDEX)
+        seen = SeenSet(SEEN_INDEX)
+    return seen
+
+def isSeen(at_uri, bot):
+    # Cheap check that doesn't touch the filesystem. If this is True, status() will tell you where it is.
+    return hashedName(at_uri, bot) in seenSet()
+
 def status(at_uri, bot):
     # refer to posts by their uri hash to avoid dealing with untrusted filesystem paths
     fn = hashedName(at_uri, bot)
     for s in statuses:
-        if os.path.exists(QUEUE_ROOT + '/' + s + '/' + fn):
+        if os.path.exists(itemFile(s, fn)):
             return s
+    if isArchiveCreated():
+        return archive().status(fn)
     return None
 
-def markIgnored(at_uri, bot):
+def markIgnored(at_uri, bot, reason=None):
     fn = hashedName(at_uri, bot)
     item = {
         "atURI": at_uri,
         "botName": bot
     }
-    with open(QUEUE_ROOT + '/ignored/' + fn, 'w') as f:
-        json.dump(item, f, indent=4)
+    if reason is not None:
+        item['x_ignored_reason'] = reason
+    writeItem('ignored', fn, item)
+    seenSet().add(fn)
 
-def queueForPayload(at_uri, bot):
+def queueForPayload(at_uri, bot, reply_parent_uri=None):
     fn = hashedName(at_uri, bot)
     item = {
         "atURI": at_uri,
         "botName": bot 
     }
-    with open(QUEUE_ROOT + '/payload/' + fn, 'w') as f:
-        json.dump(item, f, indent=4)
+    # So prepare_payload can fetch the post being replied to without having to read this one first
+    if reply_parent_uri is not None:
+        item['x_reply_parent_uri'] = reply_parent_uri
+    timeline.enqueued(item, 'payload')
+    writeItem('payload', fn, item)
+    seenSet().add(fn)
 
 def updateStatus(at_uri, bot, from_status, to_status, new_content=None):
     fn = hashedName(at_uri, bot)
-    os.rename(QUEUE_ROOT + '/' + from_status + '/' + fn, QUEUE_ROOT + '/' + to_status + '/' + fn)
     if new_content is not None:
-        with open(QUEUE_ROOT + '/' + to_status + '/' + fn, 'w') as f:
-            json.dump(new_content, f, indent=4)
+        timeline.finished(new_content, from_status, to_status)
+    if from_status in ARCHIVED_STATUSES and not os.path.exists(itemFile(from_status, fn)) and isArchiveCreated() and archive().status(fn) == from_status:
+        # Moving something back out of the archive, which should be rare
+        if new_content is None:
+            new_content = blobs.unpack(json.loads(archive().read(fn)))
+        writeItem(to_status, fn, new_content)
+        archive().remove(fn)
+        return
+    if new_content is not None:
+        # Update it where it is first, then move it, so it is only ever in one status.
+        # If we die in between it stays in the old status with the new content.
+        writeItem(from_status, fn, new_content)
+    os.makedirs(itemDir(to_status, fn), exist_ok=True)
+    os.rename(itemFile(from_status, fn), itemFile(to_status, fn))
+
+def rewriteItem(at_uri, bot, status, new_content):
+    # Replace an item without moving it
+    writeItem(status, hashedName(at_uri, bot), new_content)
+
+def depth(status):
+    count = 0
+    for entry in listEntries(status):
+        count = count + 1
+    if status in ARCHIVED_STATUSES and isArchiveCreated():
+        count = count + archive().count(status)
+    return count
 
 def readNext(status):
-    items = os.listdir(QUEUE_ROOT + '/' + status)
-    if len(items) == 0:
-        return None
-    with open(QUEUE_ROOT + '/' + status + '/' + items[0]) as f:
+    for entry in listEntries(status):
+        item = loadItem(entry.path)
+        timeline.claimed(item, status)
+        return item
+    return None
+
+def loadSchedule():
+    if not os.path.exists(SCHEDULE_CONFIG):
+        return {}
+    with open(SCHEDULE_CONFIG) as f:
         return json.load(f)
 
+def botSetting(schedule, bot, name, default):
+    if bot in schedule and name in schedule[bot]:
+        return schedule[bot][name]
+    if 'default' in schedule and name in schedule['default']:
+        return schedule['default'][name]
+    return default
+
+def botForFilename(status, fn, bot_prefixes):
+    # The filename starts with the bot name, so we can usually tell whose it is without opening it
+    for prefix, bot in bot_prefixes:
+        if fn.startswith(prefix):
+            return bot
+    try:
+        with open(itemFile(status, fn)) as f:
+            return json.load(f)['botName']
+    except FileNotFoundError:
+        return None
+
+def readFair(status):
+    # Yields the items with the status, taking turns between bots so a flood for one bot doesn't hold up the others.
+    # It uses smooth weighted round robin: each turn, every bot with items waiting gains its weight in credit,
+    # and the one with the most goes next and pays back the total. Each bot's own items come oldest first.
+    # A bot with maxPerRun set only gets that many, the rest wait for the next run.
+    schedule = loadSchedule()
+
+    bots = set(bot_registry.bots().keys()) | set(schedule.keys())
+    # Longest first, so a bot whose name starts with another bot's name gets its own items
+    bot_prefixes = [(sanitize_filename(bot + '-'), bot) for bot in sorted(bots, key=len, reverse=True)]
+
+    by_bot = {}
+    for entry in listEntries(status):
+        bot = botForFilename(status, entry.name, bot_prefixes)
+        if bot is None:
+            continue
+        by_bot.setdefault(bot, []).append((entry.stat().st_mtime_ns, entry.name))
+    for bot in by_bot:
+        by_bot[bot] = collections.deque(sorted(by_bot[bot]))
+
+    credit = {bot: 0 for bot in by_bot}
+    taken = {bot: 0 for bot in by_bot}
+    while len(by_bot) > 0:
+        total_weight = 0
+        for bot in by_bot:
+            weight = botSetting(schedule, bot, 'weight', 1)
+            credit[bot] = credit[bot] + weight
+            total_weight = total_weight + weight
+        bot = max(by_bot, key=lambda b: credit[b])
+        credit[bot] = credit[bot] - total_weight
+
+        mtime, fn = by_bot[bot].popleft()
+        item = None
+        try:
+            item = loadItem(itemFile(status, fn))
+        except FileNotFoundError:
+            # Something else moved it since we listed the directory
+            pass
+        if item is not None:
+            taken[bot] = taken[bot] + 1
+
+        max_per_run = botSetting(schedule, bot, 'maxPerRun', None)
+        if max_per_run is not None and taken[bot] >= max_per_run and len(by_bot[bot]) > 0:
+            print("Reached maxPerRun for " + bot + ", leaving " + str(len(by_bot[bot])) + " " + status + " items for next time")
+            del by_bot[bot]
+        elif len(by_bot[bot]) == 0:
+            del by_bot[bot]
+
+        if item is not None:
+            timeline.claimed(item, status)
+            yield item
+
+def iterItems(status):
+    # Everything with the status, without claiming it
+    for entry in listEntries(status):
+        try:
+            item = loadItem(entry.path)
+        except FileNotFoundError:
+            continue
+        yield item
+    if status in ARCHIVED_STATUSES and isArchiveCreated():
+        for fn, data in archive().iterItems(status):
+            yield blobs.unpack(json.loads(data))
+
 def readItem(at_uri, bot, status):
     fn = hashedName(at_uri, bot)
-    with open(QUEUE_ROOT + '/' + status + '/' + fn) as f:
-        return json.load(f)
+    try:
+        return loadItem(itemFile(status, fn))
+    except FileNotFoundError:
+        if status not in ARCHIVED_STATUSES or not isArchiveCreated():
+            raise
+        data = archive().read(fn)
+        if data is None:
+            raise
+        return blobs.unpack(json.loads(data))
+
+def compact(status, min_age, batch_size=1000):
+    # Moves items that have had the status for at least min_age seconds into the archive.
+    # Returns how many were moved.
+    if status not in ARCHIVED_STATUSES:
+        raise Exception("Only " + ", ".join(ARCHIVED_STATUSES) + " can be archived")
+    cutoff = time.time() - min_age
+    count = 0
+    batch = []
+    for entry in listEntries(status):
+        if entry.stat().st_mtime > cutoff:
+            continue
+        with open(entry.path, 'rb') as f:
+            batch.append((entry.name, entry.path, f.read()))
+        if len(batch) >= batch_size:
+            count = count + archiveBatch(status, batch)
+            batch = []
+    count = count + archiveBatch(status, batch)
+    return count
+
+def archiveBatch(status, batch):
+    archive().add([(fn, status, data) for fn, path, data in batch])
+    # Only remove the files once the archive has them
+    for fn, path, data in batch:
+        os.unlink(path)
+    return len(batch)
@@ -0,0 +1,158 @@
+# Watches plc.directory for updates to the DIDs we care about, without needing a copy of the whole directory.
+
+# This does the same job as watch_did_update.py, but instead of querying a Postgres PLC mirror
+# it reads the plc.directory export stream from where it left off last time.
+# Any operation for a DID that is active on the SkeetGateway is added to our cached audit log for that DID
+# and the DID is queued for prepare_did_update.py.
+
+# DIDs we haven't seen before are queued straight away, as prepare_did_update.py fetches their whole history.
+
+# To try it against a local stand-in for plc.directory, run plc_export_server.py and pass --export-url http://localhost:2583
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import datetime
+
+import requests
+from dotenv import load_dotenv
+
+import did_queue
+import find_active_dids
+import metrics
+
+load_dotenv(dotenv_path='.env')
+
+PLC_EXPORT_URL = os.getenv('PLC_EXPORT_URL', 'https://plc.directory')
+
+PLC_CACHE = './plcs'
+
+STATE_FILE = 'plc_export_cursor.json'
+
+# The most plc.directory will give us in one request
+EXPORT_PAGE_SIZE = 1000
+
+# Be nice to plc.directory when we're catching up
+EXPORT_PAGE_DELAY = float(os.getenv('PLC_EXPORT_PAGE_DELAY', 0.5))
+
+# Statuses where the DID has nothing pending, so a new operation means we need to queue it again.
+# (report is included because nothing reads the DID report queue yet.)
+REQUEUE_STATUSES = [None, 'report', 'completed']
+
+def loadState():
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    # The first time we start from now, anything older will be in the audit log we fetch for each DID
+    return {
+        "after": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z'),
+        "subscribedDids": []
+    }
+
+def saveState(state):
+    tmp_file = STATE_FILE + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp_file, STATE_FILE)
+
+def queueIfIdle(did):
+    status = did_queue.status(did)
+    if status not in REQUEUE_STATUSES:
+        return
+    if status is None:
+        did_queue.queueForPayload(did)
+    else:
+        # Move it back rather than queueing a new one, so it's only ever in one status
+        did_queue.updateStatus(did, status, 'payload', {"did": did})
+    print("Queued: "+did)
+
+def appendToAuditLogCache(entry):
+    # If we already have the audit log cached, keep it up to date. If not, prepare_did_update.py will fetch it.
+    # handle.sh only clears plcs/ when it uses the mirror, so when we're tailing the cache is kept between runs.
+    # Appending to a log we don't have would leave it missing the earlier operations, so we leave that to the fetch.
+    plc_file = PLC_CACHE + '/' + hashlib.sha256(entry['did'].encode()).hexdigest() + '.plc'
+    if not os.path.exists(plc_file):
+        return
+    with open(plc_file) as f:
+        history = json.load(f)
+    for existing in history:
+        if existing['cid'] == entry['cid']:
+            return
+    history.append(entry)
+    tmp_file = plc_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(history, f)
+    os.replace(tmp_file, plc_file)
+
+def tail(session, export_url, state, subscribed):
+    count_matched = 0
+    while True:
+        with metrics.timer('plc_request_seconds', {"call": "export"}):
+            response = session.get(export_url + '/export', params={"after": state['after'], "count": EXPORT_PAGE_SIZE}, stream=True, timeout=60)
+            response.raise_for_status()
+
+        count_lines = 0
+        updated_dids = []
+        for line in response.iter_lines():
+            if not line:
+                continue
+            entry = json.loads(line)
+            count_lines = count_lines + 1
+            state['after'] = entry['createdAt']
+            if entry['did'] not in subscribed:
+                continue
+            count_matched = count_matched + 1
+            appendToAuditLogCache(entry)
+            if entry['did'] not in updated_dids:
+                updated_dids.append(entry['did'])
+
+        for did in updated_dids:
+            queueIfIdle(did)
+
+        # Only move the cursor once everything in the page is queued
+        saveState(state)
+
+        if count_lines < EXPORT_PAGE_SIZE:
+            break
+        time.sleep(EXPORT_PAGE_DELAY)
+
+    return count_matched
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--export-url", default=PLC_EXPORT_URL, help="plc.directory or something that serves the same /export endpoint")
+    parser.add_argument("--after", help="timestamp to start reading from, instead of where we left off")
+    args = parser.parse_args()
+
+    did_queue.prepare()
+    if not os.path.exists(PLC_CACHE):
+        os.mkdir(PLC_CACHE)
+
+    state = loadState()
+    if args.after is not None:
+        state['after'] = args.after
+
+    subscribed = set()
+    for did, latest_block in find_active_dids.didByLatestBlock():
+        subscribed.add(did)
+
+    if len(subscribed) == 0:
+        print("No active dids found, try running index_events.py")
+        sys.exit()
+
+    # New DIDs need their whole history, not just what turns up in the export from now on
+    previously_subscribed = set(state['subscribedDids'])
+    for did in subscribed:
+        if did not in previously_subscribed:
+            queueIfIdle(did)
+    state['subscribedDids'] = sorted(subscribed)
+    saveState(state)
+
+    with requests.Session() as session:
+        count_matched = tail(session, args.export_url, state, subscribed)
+
+    print("Found " + str(count_matched) + " operations for " + str(len(subscribed)) + " subscribed dids, up to " + state['after'])
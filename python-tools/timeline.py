@@ -0,0 +1,90 @@
+# Keeps a record on each queue item of when it went through each stage, so we can see where a slow skeet spent its time.
+
+# Items get an x_timeline list with an entry for each status they have been queued in:
+#   status:  The queue status, eg payload or tx
+#   enqueue: When it was put in that status
+#   claim:   When a script read it off the queue
+#   start:   When the script started working on it
+#   finish:  When it was moved on to the next status
+#   calls:   External calls made while it was being worked on, with how long each took
+# Times are unix timestamps. Items queued before we did this will be missing the earlier parts.
+
+# The queue modules handle enqueue, claim and finish. Scripts wrap the work in running().
+# timeline_report.py turns these into percentiles for each stage.
+
+import time
+import contextlib
+
+import metrics
+
+# Entries for the items being worked on right now, which external calls get recorded against
+active_entries = []
+
+def _entry(item, status):
+    # The current entry for the status, or a new one if it has moved on since
+    if 'x_timeline' not in item:
+        item['x_timeline'] = []
+    timeline = item['x_timeline']
+    if len(timeline) > 0 and timeline[-1].get('status') == status and 'finish' not in timeline[-1]:
+        return timeline[-1]
+    entry = {"status": status}
+    timeline.append(entry)
+    return entry
+
+def enqueued(item, status):
+    _entry(item, status)['enqueue'] = time.time()
+
+def claimed(item, status):
+    entry = _entry(item, status)
+    if 'claim' not in entry:
+        entry['claim'] = time.time()
+
+def started(item, status):
+    entry = _entry(item, status)
+    if 'start' not in entry:
+        entry['start'] = time.time()
+    if 'calls' not in entry:
+        entry['calls'] = []
+    return entry
+
+def addCall(item, status, call, seconds):
+    # For calls made somewhere running() can't see them, like another thread
+    started(item, status)['calls'].append({"call": call, "seconds": seconds})
+
+def finished(item, from_status, to_status):
+    _entry(item, from_status)['finish'] = time.time()
+    enqueued(item, to_status)
+
+def carry(from_item, to_item):
+    # For when a stage makes a new item to replace the one it read off the queue
+    if 'x_timeline' in from_item:
+        to_item['x_timeline'] = from_item['x_timeline']
+    return to_item
+
+@contextlib.contextmanager
+def running(items, status):
+    # Marks the items as being worked on, and records any external calls made until we're done.
+    # Pass a list to share the calls between several items handled together, like a batch transaction.
+    if isinstance(items, dict):
+        items = [items]
+    entries = [started(item, status) for item in items]
+    active_entries.extend(entries)
+    try:
+        yield
+    finally:
+        # By identity, two items could have entries that are equal
+        active_entries[:] = [e for e in active_entries if not any(e is entry for entry in entries)]
+
+def _recordCall(name, labels, seconds):
+    if len(active_entries) == 0:
+        return
+    if name == 'stage_seconds':
+        return
+    # eg rpc_request_seconds with method eth_call becomes rpc_request:eth_call
+    call = name.replace('_seconds', '')
+    if labels is not None and len(labels) > 0:
+        call = call + ':' + ','.join([str(labels[k]) for k in sorted(labels)])
+    for entry in active_entries:
+        entry['calls'].append({"call": call, "seconds": seconds})
+
+metrics.listeners.append(_recordCall)
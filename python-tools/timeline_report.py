@@ -0,0 +1,96 @@
+# Summarizes the x_timeline recorded on queue items, to show which stage is slow and what it spends its time on.
+
+# For each queue status it prints the 50th, 95th and 99th percentile in seconds of:
+#   wait:  From being queued to a script reading it
+#   run:   From the script starting work on it to moving it on
+#   total: From being queued to moving it on
+# With --calls it also breaks down the external calls made at each stage.
+
+import sys
+import time
+import argparse
+
+import skeet_queue
+import did_queue
+
+QUEUES = {
+    "skeet_queue": skeet_queue,
+    "did_queue": did_queue
+}
+
+PERCENTILES = [50, 95, 99]
+
+def percentile(sorted_values, p):
+    # Nearest rank, so it's always a value we actually saw
+    idx = max(0, -(-len(sorted_values) * p // 100) - 1)
+    return sorted_values[idx]
+
+def collect(queue, since):
+    # Returns {stage: {measure: [seconds]}}, where measure is wait, run, total or an external call
+    durations = {}
+    for status in queue.statuses:
+        for item in queue.iterItems(status):
+            for entry in item.get('x_timeline', []):
+                if 'finish' not in entry:
+                    continue
+                if since is not None and entry['finish'] < since:
+                    continue
+                stage = durations.setdefault(entry['status'], {})
+                if 'enqueue' in entry and 'claim' in entry:
+                    stage.setdefault('wait', []).append(entry['claim'] - entry['enqueue'])
+                if 'start' in entry:
+                    stage.setdefault('run', []).append(entry['finish'] - entry['start'])
+                if 'enqueue' in entry:
+                    stage.setdefault('total', []).append(entry['finish'] - entry['enqueue'])
+                # Add up repeated calls so we see what each item spent on each kind of call
+                by_call = {}
+                for c in entry.get('calls', []):
+                    by_call[c['call']] = by_call.get(c['call'], 0) + c['seconds']
+                for call in by_call:
+                    stage.setdefault('call ' + call, []).append(by_call[call])
+    return durations
+
+def printReport(queue_name, durations, show_calls):
+    print(queue_name)
+    header = "  {:<16} {:<40} {:>7}".format("stage", "measure", "count")
+    for p in PERCENTILES:
+        header = header + " {:>10}".format("p" + str(p))
+    print(header)
+    for stage in sorted(durations):
+        for measure in sorted(durations[stage], key=lambda m: (m.startswith('call '), m)):
+            if measure.startswith('call ') and not show_calls:
+                continue
+            values = sorted(durations[stage][measure])
+            line = "  {:<16} {:<40} {:>7}".format(stage, measure, len(values))
+            for p in PERCENTILES:
+                line = line + " {:>10.3f}".format(percentile(values, p))
+            print(line)
+    print("")
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queue", choices=sorted(QUEUES.keys()), help="only report on this queue")
+    parser.add_argument("--hours", type=float, help="only include stages finished in the last this many hours")
+    parser.add_argument("--calls", action="store_true", help="show the time spent on each kind of external call")
+    args = parser.parse_args()
+
+    since = None
+    if args.hours is not None:
+        since = time.time() - args.hours * 3600
+
+    queue_names = sorted(QUEUES.keys())
+    if args.queue is not None:
+        queue_names = [args.queue]
+
+    is_found = False
+    for queue_name in queue_names:
+        durations = collect(QUEUES[queue_name], since)
+        if len(durations) == 0:
+            continue
+        is_found = True
+        printReport(queue_name, durations, args.calls)
+
+    if not is_found:
+        print("No finished stages with timelines found")
+        sys.exit(1)
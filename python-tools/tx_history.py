@@ -1,80 +1,52 @@
-import web3
-from eth_account import Account
 import os
 import json
-import time
-import sys
 
-import hashlib
+import event_store
 
-import skeet_queue
+# Payloads executed by the SkeetGateway, looked up by content hash.
+# The logs are scanned by index_events.py, which calls handleEvent for each LogExecutePayload.
+# They're stored in event_store, so we only ever append the new ones.
 
-from dotenv import load_dotenv
+EVENT_NAME = 'LogExecutePayload'
 
-load_dotenv(dotenv_path='../contract/.env')
-
-skeet_queue.prepare()
-
-url = os.getenv('SEPOLIA_RPC_URL')
-w3 = web3.Web3(web3.HTTPProvider(url))
-
-GATEWAY_ADDRESS = os.getenv('SKEET_GATEWAY')
-DEPLOYMENT_BLOCK = os.getenv('DEPLOYMENT_BLOCK')
-
-ABI_FILE = "../contract/out/SkeetGateway.sol/SkeetGateway.json"
-ACCOUNT = Account.from_key(os.getenv('PRIVATE_KEY'))
-
-with open(ABI_FILE) as f:
-    d = json.load(f)
-
-GATEWAY_ABI = d['abi']
-
-gateway = w3.eth.contract(address=GATEWAY_ADDRESS, abi=GATEWAY_ABI)
-
-tx_hist = {
-    "lastBlock": DEPLOYMENT_BLOCK,
-    "txByContentHash": {}
-}
+EVENT_NAMES = [EVENT_NAME]
 
+# Where we used to keep the whole history, imported the first time we run
 TX_FILE = "tx_hist.json"
 
-if __name__ == '__main__':
-
-    if os.path.exists(TX_FILE):
-        with open(TX_FILE) as f:
-            tx_hist = json.load(f) 
-
-    latest_block = w3.eth.block_number
-    block_number = int(tx_hist['lastBlock'])
-    countLoaded = 0
-    while block_number < latest_block:
-        from_block = block_number
-        to_block = block_number + 999
-        if to_block > latest_block:
-            to_block = latest_block
-        block_number = to_block
+def hasState():
+    return os.path.exists(event_store.STORE_FILE)
+
+def load():
+    if event_store.count(EVENT_NAME) > 0 or not os.path.exists(TX_FILE):
+        return
+    with open(TX_FILE) as f:
+        tx_hist = json.load(f) 
+    for content_hash in tx_hist['txByContentHash']:
+        event_store.append(EVENT_NAME, content_hash, 0, event_store.UNKNOWN_LOG_INDEX, tx_hist['txByContentHash'][content_hash])
+    event_store.commit()
+    print("imported " + str(len(tx_hist['txByContentHash'])) + " entries from " + TX_FILE)
+
+def handleEvent(log):
+    content_hash = "0x"+log['args']['contentHash'].hex()
+    to = log['args']['to']
+    data = "0x"+log['args']['data'].hex()
+    value = log['args']['value']
+    txid = log['transactionHash'].to_0x_hex()
+    event_store.append(EVENT_NAME, content_hash, log['blockNumber'], log['logIndex'], {
+        "txid": txid,
+        "to": to,
+        "data": data,
+        "value": value
+    })
+
+def save(last_block):
+    event_store.commit()
+
+def txByContentHash(content_hash):
+    return event_store.lookup(EVENT_NAME, content_hash)
 
-        isFound = False
-        print("fetch range "+str(from_block) + "-" + str(to_block))
-        logs = gateway.events.LogExecutePayload().get_logs(from_block=from_block, to_block = to_block)
-        for log in logs:
-            content_hash = "0x"+log['args']['contentHash'].hex()
-            to = log['args']['to']
-            data = "0x"+log['args']['data'].hex()
-            value = log['args']['value']
-            txid = log['transactionHash'].to_0x_hex()
-            tx_hist["txByContentHash"][content_hash] = {
-                "txid": txid,
-                "to": to,
-                "data": data,
-                "value": value
-            }
-            countLoaded = countLoaded + 1
-            isFound = True
-
-        if isFound:
-            print("loaded "+str(countLoaded))
-
-    tx_hist['lastBlock'] = block_number
-    with open(TX_FILE, 'w', encoding='utf-8') as f:
-        json.dump(tx_hist, f, ensure_ascii=False, indent=4)
+if __name__ == '__main__':
+    # All the gateway events are scanned in one pass, so this updates the other handlers too
+    import index_events
+    index_events.run()
@@ -5,11 +5,11 @@ import psycopg
 
 import time
 
-import json
 import hashlib
 import libipld
 
 import did_queue
+import find_active_dids
 
 
 load_dotenv(dotenv_path='.plc_env')
@@ -20,25 +20,31 @@ PLC_MIRROR_DB = os.getenv('PLC_MIRROR_DB')
 PLC_MIRROR_USER = os.getenv('PLC_MIRROR_USER')
 PLC_MIRROR_PWD = os.getenv('PLC_MIRROR_PWD')
 
+# A column in plc_log_entries that increases as entries are added, so we can pick up where we left off.
+# The plc mirror uses an auto-incrementing id.
+PLC_MIRROR_CURSOR_COLUMN = os.getenv('PLC_MIRROR_CURSOR_COLUMN', 'id')
+
+# Entries may be committed out of id order: the mirror takes an id when it inserts a row but other passes can't see it
+# until its transaction commits, so a pass can move the cursor past an id that turns up later.
+# So as well as everything after the cursor, each pass looks at anything the mirror stamped less than
+# PLC_MIRROR_CURSOR_OVERLAP_SECS before the last pass started. The mirror sets that time when it writes the row,
+# before committing, so this holds as long as its transactions (and any clock difference between it and the
+# database) take less than that. Anything we already handled in that range is skipped because it's already in shadow_updates.
+PLC_MIRROR_TIME_COLUMN = os.getenv('PLC_MIRROR_TIME_COLUMN', 'created_at')
+PLC_MIRROR_CURSOR_OVERLAP_SECS = int(os.getenv('PLC_MIRROR_CURSOR_OVERLAP_SECS', 600))
+
 # Watch contracts for interest in DID
 # If found, add to db subscription list
 #  SkeetGateway.LogHandleAccount has did
 
 did_queue.prepare()
 
-DID_HISTORY_FILE = 'did_hist.json'
-
-did_json = {}
-with open(DID_HISTORY_FILE) as f:
-    did_json = json.load(f)
-
 dids = []
-if 'didByLatestBlock' in did_json:
-    for did in did_json['didByLatestBlock']:
-        dids.append(did)
+for did, latest_block in find_active_dids.didByLatestBlock():
+    dids.append(did)
 
 if len(dids) == 0:
-    print("No dids found in did_hist.json")
+    print("No active dids found, try running index_events.py")
     sys.exit()
 
 # Watch subscription list for unpublished changes
@@ -55,6 +61,31 @@ if len(dids) == 0:
 # Watch contracts for shadowed changes
 # If found, mark done in db
 
+def hasIndexOn(cur, table, column, unique=False):
+    # Any index whose leading column is the one we filter or join on will do, whoever created it.
+    # For "on conflict" we need a unique index on exactly that column.
+    cur.execute("""
+        select count(*)
+            from pg_index i
+                inner join pg_class t on t.oid = i.indrelid
+                inner join pg_attribute a on a.attrelid = t.oid and a.attnum = i.indkey[0]
+            where t.relname = %s and a.attname = %s
+                and (not %s or (i.indisunique and i.indnatts = 1))
+    """, (table, column, unique,))
+    return cur.fetchone()[0] > 0
+
+def ensureIndex(cur, table, column, unique=False):
+    if hasIndexOn(cur, table, column, unique):
+        return
+    index_name = table + '_' + column
+    print("creating index " + index_name)
+    if unique:
+        cur.execute('CREATE UNIQUE INDEX if not exists ' + index_name + ' on ' + table + ' (' + column + ')')
+    else:
+        cur.execute('CREATE INDEX if not exists ' + index_name + ' on ' + table + ' (' + column + ')')
+    if not hasIndexOn(cur, table, column, unique):
+        raise Exception("Could not create index on " + table + "." + column)
+
 # Connect to an existing database
 with psycopg.connect(host=PLC_MIRROR_HOST, port=PLC_MIRROR_PORT, dbname=PLC_MIRROR_DB, user=PLC_MIRROR_USER, password=PLC_MIRROR_PWD) as conn:
 
@@ -73,6 +104,17 @@ with psycopg.connect(host=PLC_MIRROR_HOST, port=PLC_MIRROR_PORT, dbname=PLC_MIRR
         );
     """
 
+    create_sql = create_sql + """
+        CREATE TABLE if not exists shadow_cursor (
+          name text PRIMARY KEY,
+          last_id bigint NOT NULL
+        );
+
+        ALTER TABLE shadow_cursor ADD COLUMN if not exists scanned_at timestamptz;
+    """
+
+    # Entries for subscribed DIDs that we haven't made a shadow update for yet.
+    # The caller adds a condition to limit which entries we look at.
     missing_sql = """
         select s.did, p.cid, p.operation
             from plc_log_entries p 
@@ -81,31 +123,75 @@ with psycopg.connect(host=PLC_MIRROR_HOST, port=PLC_MIRROR_PORT, dbname=PLC_MIRR
             left outer join 
                 shadow_updates u 
                 on p.cid=u.cid 
-            where u.cid is null;
+            where u.cid is null and 
     """
 
-    # create index cid on public.plc_log_entries using btree(cid)
-
     # Open a cursor to perform database operations
     with conn.cursor() as cur:
 
         cur.execute(create_sql)
 
-        for did in dids:
-            cur.execute('SELECT count(*) FROM subscribed_dids where did = %s', (did,))
-            num_arr = cur.fetchone()
-            num = num_arr[0]
-            if num == 0:
-                print("insert did" + did)
-                cur.execute('insert into subscribed_dids(did, sent_ts) values (%s,%s)', (did,int(time.time()),))
+        # The upsert needs a unique index on did. Older versions didn't make one, but also didn't insert duplicates.
+        if not hasIndexOn(cur, 'subscribed_dids', 'did', unique=True):
+            cur.execute('DELETE FROM subscribed_dids a USING subscribed_dids b WHERE a.did = b.did AND a.ctid > b.ctid')
+        ensureIndex(cur, 'subscribed_dids', 'did', unique=True)
+
+        # The missing_sql join needs these. The mirror may already have them.
+        ensureIndex(cur, 'plc_log_entries', 'did')
+        ensureIndex(cur, 'plc_log_entries', 'cid')
+        ensureIndex(cur, 'plc_log_entries', PLC_MIRROR_CURSOR_COLUMN)
+        ensureIndex(cur, 'plc_log_entries', PLC_MIRROR_TIME_COLUMN)
+        ensureIndex(cur, 'shadow_updates', 'cid', unique=True)
         conn.commit()
 
-        cur.execute(missing_sql)
-        insert_me = []
+        cur.execute("""
+            insert into subscribed_dids(did, sent_ts)
+                select unnest(%s::text[]), %s
+            on conflict (did) do nothing
+            returning did
+        """, (dids, int(time.time()),))
+        new_dids = []
         for record in cur:
+            print("insert did" + record[0])
+            new_dids.append(record[0])
+
+        cur.execute('SELECT last_id, scanned_at FROM shadow_cursor where name = %s', ('plc_log_entries',))
+        cursor_row = cur.fetchone()
+
+        # Anything added after this will be picked up next time.
+        # now() is when this transaction started, so it's no later than when we read the max.
+        cur.execute('SELECT coalesce(max(' + PLC_MIRROR_CURSOR_COLUMN + '), 0), now() FROM plc_log_entries')
+        max_id, scanned_at = cur.fetchone()
+
+        missing_records = []
+        if cursor_row is None:
+            # First time, so look at everything
+            print("No cursor yet, checking all entries for subscribed dids")
+            cur.execute(missing_sql + ' p.' + PLC_MIRROR_CURSOR_COLUMN + ' <= %s', (max_id,))
+            missing_records.extend(cur.fetchall())
+        else:
+            last_id, last_scanned_at = cursor_row
+            if last_scanned_at is None:
+                # Saved before we recorded the time, so all we can do this once is go by the id
+                cur.execute(missing_sql + ' p.' + PLC_MIRROR_CURSOR_COLUMN + ' > %s and p.' + PLC_MIRROR_CURSOR_COLUMN + ' <= %s', (last_id, max_id,))
+            else:
+                cur.execute(missing_sql + ' (p.' + PLC_MIRROR_CURSOR_COLUMN + ' > %s or p.' + PLC_MIRROR_TIME_COLUMN + ' > %s - make_interval(secs => %s)) and p.' + PLC_MIRROR_CURSOR_COLUMN + ' <= %s', (last_id, last_scanned_at, PLC_MIRROR_CURSOR_OVERLAP_SECS, max_id,))
+            missing_records.extend(cur.fetchall())
+            # The cursor only covers entries added since last time, so new subscribers need their whole history
+            if len(new_dids) > 0:
+                cur.execute(missing_sql + ' p.did = any(%s) and p.' + PLC_MIRROR_CURSOR_COLUMN + ' <= %s', (new_dids, max_id,))
+                missing_records.extend(cur.fetchall())
+
+        insert_me = []
+        updated_dids = []
+        seen_cids = set()
+        for record in missing_records:
             missing_did = record[0]
             missing_cid = record[1]
             missing_op = record[2]
+            if missing_cid in seen_cids:
+                continue
+            seen_cids.add(missing_cid)
 
             signed_op = missing_op.copy()
             del signed_op["sig"]
@@ -114,18 +200,24 @@ with psycopg.connect(host=PLC_MIRROR_HOST, port=PLC_MIRROR_PORT, dbname=PLC_MIRR
             # insert_me.append((missing_cid, sighash ,int(time.time()),))
             insert_me.append((missing_cid, sighash, 0,))
             # print(sig_hash)
-            print("read record")
+            if missing_did not in updated_dids:
+                updated_dids.append(missing_did)
 
-        for me in insert_me:
-            print("insert cid")
-            cur.execute('insert into shadow_updates(cid, sighash, sent_ts) values (%s,%s,%s)', me)
-
-        conn.commit()
+        print("insert " + str(len(insert_me)) + " cids")
+        cur.executemany('insert into shadow_updates(cid, sighash, sent_ts) values (%s,%s,%s) on conflict do nothing', insert_me)
 
-        cur.execute('SELECT distinct(did) from shadow_updates u inner join plc_log_entries p on u.cid=p.cid where u.sent_ts = %s', (0,))
-        for record in cur:
-            did = record[0]
+        # Queue before we commit, so if we die in between we find the same entries again next time.
+        # Queueing something twice does no harm.
+        for did in updated_dids:
             status = did_queue.status(did)
             if status is None:
                 did_queue.queueForPayload(did)
                 print("Queued: "+did)
+
+        # Move the cursor in the same transaction, so we never skip entries we didn't record
+        cur.execute("""
+            insert into shadow_cursor(name, last_id, scanned_at) values (%s, %s, %s)
+            on conflict (name) do update set last_id = excluded.last_id, scanned_at = excluded.scanned_at
+        """, ('plc_log_entries', max_id, scanned_at,))
+
+        conn.commit()